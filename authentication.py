@@ -1,6 +1,9 @@
+import asyncio
 import os
 import secrets
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
@@ -9,6 +12,8 @@ from datetime import datetime, timedelta
 from passlib.context import CryptContext
 from dotenv import load_dotenv
 from models import User, User_Pydantic
+from cache import TTLCache
+from metrics import password_seconds, jwt_decode_seconds
 
 
 load_dotenv()
@@ -16,7 +21,22 @@ secret_key = os.getenv('SECRET')
 algorithm = 'HS256'
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+password_hash_rounds = int(os.getenv('BCRYPT_ROUNDS', 12))
+# min and max pinned to the configured work factor so any change rehashes on the next login
+pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto', bcrypt__default_rounds=password_hash_rounds,
+                           bcrypt__min_rounds=password_hash_rounds, bcrypt__max_rounds=password_hash_rounds)
+password_executor = ThreadPoolExecutor(max_workers=int(os.getenv('PASSWORD_HASH_WORKERS', 2)),
+                                       thread_name_prefix='password')
+password_queue_limit = int(os.getenv('PASSWORD_HASH_QUEUE_LIMIT', 64))
+password_metrics = {'rejected': 0, 'rehashed': 0, 'in_flight': 0}
+
+auth_cache_size = int(os.getenv('AUTH_CACHE_SIZE', 4096))
+auth_cache_ttl = int(os.getenv('AUTH_CACHE_TTL', 300))
+# token -> email -> user id -> user. Users are keyed by id, so invalidate_user reaches a cached user
+# however the email lookups in front of it were evicted
+token_cache = TTLCache(maxsize=auth_cache_size, ttl=auth_cache_ttl)
+user_ids = TTLCache(maxsize=auth_cache_size, ttl=auth_cache_ttl)
+user_cache = TTLCache(maxsize=auth_cache_size, ttl=auth_cache_ttl)
 
 
 class UserInDB(User):
@@ -29,12 +49,29 @@ class TokenData(User):
     email: str
 
 
+async def run_password_job(func, *args):
+    if password_metrics['in_flight'] >= password_queue_limit:
+        password_metrics['rejected'] += 1
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many sign-in attempts, try again later",
+            headers={"Retry-After": "1"},
+        )
+    password_metrics['in_flight'] += 1
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, func, *args)
+    finally:
+        password_metrics['in_flight'] -= 1
+        password_seconds.observe(time.perf_counter() - started, operation=func.__name__)
+
+
 async def get_hashed_password(password):
-    return pwd_context.hash(password)
+    return await run_password_job(pwd_context.hash, password)
 
 
 async def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return await run_password_job(pwd_context.verify, plain_password, hashed_password)
 
 
 async def get_user(email: str):
@@ -45,8 +82,12 @@ async def authenticate_user(email: str, password: str):
     user = await get_user(email)
     if not user:
         return False
-    if not await verify_password(password, user.password):
+    valid, new_hash = await run_password_job(pwd_context.verify_and_update, password, user.password)
+    if not valid:
         return False
+    if new_hash:
+        await User.filter(id=user.id).update(password=new_hash)
+        password_metrics['rehashed'] += 1
     return user
 
 
@@ -67,19 +108,38 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, secret_key, algorithms=[algorithm])
-        email: str = payload.get("sub")
-        if email is None:
+    email = token_cache.get(token)
+    if email is None:
+        try:
+            started = time.perf_counter()
+            payload = jwt.decode(token, secret_key, algorithms=[algorithm])
+            jwt_decode_seconds.observe(time.perf_counter() - started)
+            email: str = payload.get("sub")
+            if email is None:
+                raise credentials_exception
+        except JWTError:
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = await get_user(email=email)
+        expires = payload.get("exp")
+        token_cache.set(token, email, ttl=None if expires is None else min(auth_cache_ttl, expires - time.time()))
+    user_id = user_ids.get(email)
+    user = None if user_id is None else user_cache.get(user_id)
     if user is None:
-        raise credentials_exception
+        user = await get_user(email=email)
+        if user is None:
+            raise credentials_exception
+        user_ids.set(email, str(user.id))
+        user_cache.set(str(user.id), user)
     return user
 
 
+def invalidate_user(user_id):
+    user_cache.pop(str(user_id))
+
+
+def auth_cache_stats():
+    return {'tokens': token_cache.stats(), 'users': user_cache.stats()}
+
+
 def generate_invitation_token(length=10):
     characters = string.ascii_letters + string.digits
     token = ''.join(secrets.choice(characters) for _ in range(length))
@@ -0,0 +1,383 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, endpoint, seconds, queries, ok):
+        sample = self.samples.setdefault(endpoint, {'latencies': [], 'queries': 0, 'errors': 0})
+        sample['latencies'].append(seconds)
+        sample['queries'] += queries
+        sample['errors'] += 0 if ok else 1
+
+    def report(self, wall_seconds):
+        report = {}
+        for endpoint, sample in self.samples.items():
+            latencies = sample['latencies']
+            report[endpoint] = {
+                'requests': len(latencies),
+                'errors': sample['errors'],
+                'throughput_rps': round(len(latencies) / wall_seconds, 2) if wall_seconds else 0.0,
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+                'queries_per_request': round(sample['queries'] / len(latencies), 2),
+            }
+        return report
+
+
+async def timed(client, recorder, endpoint, method, url, expected=(200,), **kwargs):
+    # The app's own query hook counts into this scope as well as the request scope of the middleware
+    from metrics import RequestStats, current_request
+
+    stats = RequestStats(capture=False)
+    token = current_request.set(stats)
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    finally:
+        current_request.reset(token)
+    recorder.add(endpoint, time.perf_counter() - started, stats.queries, response.status_code in expected)
+    return response
+
+
+class SmtpSink:
+    # Local stand-in SMTP server accepting every message, so outbox delivery runs without a real mail server
+    def __init__(self):
+        self.messages = []
+        self.sessions = 0
+        self.server = None
+
+    async def _session(self, reader, writer):
+        self.sessions += 1
+        writer.write(b'220 benchmark ESMTP\r\n')
+        data = None
+        while line := await reader.readline():
+            if data is not None:
+                if line.rstrip(b'\r\n') != b'.':
+                    data.append(line)
+                    continue
+                self.messages.append(b''.join(data))
+                data = None
+                writer.write(b'250 OK\r\n')
+            elif line[:4].upper() == b'EHLO':
+                writer.write(b'250-benchmark\r\n250 8BITMIME\r\n')
+            elif line[:4].upper() == b'DATA':
+                data = []
+                writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+            elif line[:4].upper() == b'QUIT':
+                writer.write(b'221 Bye\r\n')
+                break
+            else:
+                writer.write(b'250 OK\r\n')
+            await writer.drain()
+        await writer.drain()
+        writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._session, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+async def gather_limited(concurrency, coroutines):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(asyncio.create_task(run(coroutine)) for coroutine in coroutines))
+
+
+async def seed(args):
+    from authentication import pwd_context, create_access_token
+    from tortoise import timezone
+    from models import User, Groups, Subjects, Subscription, Tokens
+
+    password_hash = pwd_context.hash('benchmark')
+    group = await Groups.create(group_number='BENCH-1')
+    expires = timezone.now() + timedelta(days=30)
+    moderator = await User.create(first_name='Mod', last_name='Erator', email='moderator@bench.local',
+                                  password=password_hash, group_id=group.group_id, role='moderator',
+                                  subscription_expires=expires)
+    await Subscription.create(tier=1, owner_id=moderator.id, group_population=args.redeemers, expires=expires,
+                              created_at=timezone.now(), group_id=group.group_id, months=1)
+    await User.bulk_create([User(first_name=f'Student{number}', last_name=f'Bench{number:05d}',
+                                 email=f'student{number}@bench.local', password=password_hash,
+                                 group_id=group.group_id, subscription_expires=expires)
+                            for number in range(args.users)])
+    await User.bulk_create([User(first_name=f'Guest{number}', last_name=f'Bench{number:05d}',
+                                 email=f'guest{number}@bench.local', password=password_hash)
+                            for number in range(args.redeemers)])
+    subjects = [await Subjects.create(group_id=group.group_id, subject_full_name=f'Subject {number}',
+                                      subject_short_name=f'S{number}')
+                for number in range(args.subjects)]
+    await Tokens.create(token='benchmarktoken', remaining_activations=args.activations, group_id=group.group_id,
+                        owner_id=moderator.id, expires=expires)
+
+    def bearer(email):
+        token = create_access_token(data={'sub': email}, expires_delta=timedelta(hours=2))
+        return {'Authorization': f'Bearer {token}'}
+
+    return {
+        'students': [f'student{number}@bench.local' for number in range(args.users)],
+        'guests': [f'guest{number}@bench.local' for number in range(args.redeemers)],
+        'subjects': [str(subject.id) for subject in subjects],
+        'bearer': bearer,
+    }
+
+
+async def login_storm(client, recorder, data, args):
+    emails = data['students'][:args.logins]
+    await gather_limited(args.concurrency, [
+        timed(client, recorder, 'POST /token', 'POST', '/token',
+              data={'username': email, 'password': 'benchmark'})
+        for email in emails
+    ])
+
+
+async def queue_pollers(client, recorder, data, args):
+    headers = [data['bearer'](email) for email in data['students'][:args.pollers]]
+    subject = data['subjects'][0]
+    await gather_limited(args.concurrency, [
+        timed(client, recorder, 'GET /infoqueue/get_queue/{subject}', 'GET', f'/infoqueue/get_queue/{subject}',
+              headers=header)
+        for _ in range(args.rounds) for header in headers
+    ])
+    await gather_limited(args.concurrency, [
+        timed(client, recorder, 'GET /infoqueue/get_subjects/', 'GET', '/infoqueue/get_subjects/', headers=header)
+        for header in headers
+    ])
+    await gather_limited(args.concurrency, [
+        timed(client, recorder, 'GET /users/list_of_users/', 'GET', '/users/list_of_users/', headers=header)
+        for header in headers
+    ])
+
+
+async def queue_churn(client, recorder, data, args):
+    headers = [data['bearer'](email) for email in data['students']]
+    subjects = data['subjects']
+
+    async def cycle(number, header):
+        subject = subjects[number % len(subjects)]
+        await timed(client, recorder, 'POST /infoqueue/add_to_queue/', 'POST', '/infoqueue/add_to_queue/',
+                    headers=header, json={'task_number': number % 7 + 1, 'subject_number': subject})
+        await timed(client, recorder, 'DELETE /infoqueue/complete/{subject}', 'DELETE',
+                    f'/infoqueue/complete/{subject}', headers=header)
+
+    await gather_limited(args.concurrency, [cycle(number, header) for number, header in enumerate(headers)])
+
+
+async def token_redemption(client, recorder, data, args):
+    from models import Tokens
+
+    headers = [data['bearer'](email) for email in data['guests']]
+    responses = await gather_limited(args.concurrency, [
+        timed(client, recorder, 'POST /user/enter_invitation_token/{token}', 'POST',
+              '/user/enter_invitation_token/benchmarktoken', expected=(200, 400), headers=header)
+        for header in headers
+    ])
+    accepted = sum(1 for response in responses if response.status_code == 200)
+    token = await Tokens.get(token='benchmarktoken')
+    expected = min(args.activations, len(headers))
+    return {
+        'accepted': accepted,
+        'expected_accepted': expected,
+        'remaining_activations': token.remaining_activations,
+        'exact': accepted == expected and token.remaining_activations == args.activations - expected,
+    }
+
+
+async def serialization(client, recorder, data, args):
+    # Per-row cost of the previous response_model path against the slim TypedDict dump used by the list endpoints
+    import uuid
+    from fastapi.encoders import jsonable_encoder
+    from pydantic import TypeAdapter
+    from typing import List
+    from models import InfoQueue_Pydantic, queue_entries_json
+
+    now = datetime.now()
+    rows = [{'id': number, 'user_id': uuid.uuid4(), 'position': number + 1, 'group_id': uuid.uuid4(),
+             'first_name': f'Student{number}', 'last_name': f'Bench{number:05d}', 'task_number': number % 7 + 1,
+             'subject_number': uuid.uuid4(), 'created_at': now, 'modified_at': now}
+            for number in range(args.serialization_rows)]
+    validated_list = TypeAdapter(List[InfoQueue_Pydantic])
+
+    def model_path():
+        return json.dumps(jsonable_encoder(validated_list.validate_python(rows))).encode()
+
+    def slim_path():
+        return queue_entries_json.dump_json(rows)
+
+    costs = {}
+    for name, path in (('response_model', model_path), ('slim_typed_dict', slim_path)):
+        path()
+        started = time.perf_counter()
+        for _ in range(args.serialization_repeats):
+            path()
+        elapsed = time.perf_counter() - started
+        costs[f'{name}_us_per_row'] = round(elapsed / (args.serialization_repeats * len(rows)) * 1e6, 3)
+    costs['speedup'] = round(costs['response_model_us_per_row'] / costs['slim_typed_dict_us_per_row'], 2)
+    return costs
+
+
+async def registration(client, recorder, data, args):
+    # Registration only writes an outbox row, delivery to the SMTP sink is measured separately
+    sink = data['smtp']
+    delivered_before = len(sink.messages)
+    sessions_before = sink.sessions
+    await gather_limited(args.concurrency, [
+        timed(client, recorder, 'POST /registration', 'POST', '/registration',
+              json={'first_name': f'New{number}', 'last_name': f'Bench{number:05d}',
+                    'email': f'new{number}@example.com', 'password': 'benchmark'})
+        for number in range(args.registrations)
+    ])
+    started = time.perf_counter()
+    deadline = started + args.delivery_timeout
+    while len(sink.messages) - delivered_before < args.registrations and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    delivered = len(sink.messages) - delivered_before
+    return {
+        'delivered': delivered,
+        'expected_delivered': args.registrations,
+        'smtp_sessions': sink.sessions - sessions_before,
+        'delivery_lag_seconds': round(time.perf_counter() - started, 3),
+        'exact': delivered == args.registrations,
+    }
+
+
+SCENARIOS = {
+    'login_storm': login_storm,
+    'queue_pollers': queue_pollers,
+    'queue_churn': queue_churn,
+    'token_redemption': token_redemption,
+    'serialization': serialization,
+    'registration': registration,
+}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for scenario, endpoints in results['scenarios'].items():
+        for endpoint, current in endpoints['endpoints'].items():
+            previous = baseline.get('scenarios', {}).get(scenario, {}).get('endpoints', {}).get(endpoint)
+            if previous is None:
+                continue
+            if previous['p95_ms'] and current['p95_ms'] > previous['p95_ms'] * (1 + threshold):
+                regressions.append(f"{scenario} {endpoint}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+            if current['throughput_rps'] < previous['throughput_rps'] * (1 - threshold):
+                regressions.append(f"{scenario} {endpoint}: throughput "
+                                   f"{previous['throughput_rps']} -> {current['throughput_rps']} rps")
+            if current['queries_per_request'] > previous['queries_per_request']:
+                regressions.append(f"{scenario} {endpoint}: queries/request "
+                                   f"{previous['queries_per_request']} -> {current['queries_per_request']}")
+    return regressions
+
+
+async def run(args):
+    import httpx
+
+    sink = SmtpSink()
+    os.environ['MAIL_PORT'] = str(await sink.start())
+    from main import app
+
+    await app.router.startup()
+    try:
+        data = await seed(args)
+        data['smtp'] = sink
+        results = {'created_at': datetime.now().isoformat(), 'arguments': vars(args).copy(), 'scenarios': {}}
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+            for name in args.scenario or SCENARIOS:
+                recorder = Recorder()
+                started = time.perf_counter()
+                checks = await SCENARIOS[name](client, recorder, data, args)
+                wall_seconds = time.perf_counter() - started
+                results['scenarios'][name] = {'wall_seconds': round(wall_seconds, 3),
+                                              'endpoints': recorder.report(wall_seconds)}
+                if checks:
+                    results['scenarios'][name]['checks'] = checks
+        return results
+    finally:
+        await app.router.shutdown()
+        await sink.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive the API in-process against a seeded temporary SQLite '
+                                                 'database and record latency, throughput and queries per request.')
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS))
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--subjects', type=int, default=5)
+    parser.add_argument('--logins', type=int, default=50)
+    parser.add_argument('--pollers', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--redeemers', type=int, default=300)
+    parser.add_argument('--activations', type=int, default=250)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--serialization-rows', type=int, default=500)
+    parser.add_argument('--serialization-repeats', type=int, default=50)
+    parser.add_argument('--registrations', type=int, default=20)
+    parser.add_argument('--delivery-timeout', type=float, default=30.0)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', help='previous results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed relative slowdown before flagging')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['DATABASE_URL'] = f"sqlite://{os.path.join(directory, 'benchmark.sqlite3')}"
+        os.environ.setdefault('SECRET', 'benchmark-secret')
+        os.environ.update({'SECRET_EMAIL': 'benchmark@example.com', 'MAIL_SERVER': '127.0.0.1', 'MAIL_STARTTLS': '0',
+                           'MAIL_SSL_TLS': '0', 'MAIL_USE_CREDENTIALS': '0', 'MAIL_VALIDATE_CERTS': '0'})
+        os.environ.setdefault('OUTBOX_SEND_PER_SECOND', '1000')
+        os.environ.setdefault('OUTBOX_SEND_BURST', '1000')
+        results = asyncio.run(run(args))
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        results['regressions'] = regressions
+    # A scenario that checks its own outcome fails the run when the outcome is off, whatever the timings
+    failed_checks = [scenario for scenario, result in results['scenarios'].items()
+                     if result.get('checks', {}).get('exact') is False]
+    results['failed_checks'] = failed_checks
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    for scenario, result in results['scenarios'].items():
+        print(f"{scenario} ({result['wall_seconds']}s)")
+        for endpoint, stats in result['endpoints'].items():
+            print(f"  {endpoint}: {stats['requests']} req, {stats['throughput_rps']} rps, p50 {stats['p50_ms']}ms, "
+                  f"p95 {stats['p95_ms']}ms, p99 {stats['p99_ms']}ms, {stats['queries_per_request']} q/req, "
+                  f"{stats['errors']} errors")
+        if 'checks' in result:
+            print(f"  checks: {result['checks']}")
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    for scenario in failed_checks:
+        print(f"CHECK FAILED {scenario}: {results['scenarios'][scenario]['checks']}")
+    sys.exit(1 if regressions or failed_checks else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+from datetime import timedelta
+
+from tortoise import timezone
+
+from models import ChangeEvent
+
+logger = logging.getLogger('bus')
+worker_id = secrets.token_hex(8)
+bus_enabled = os.getenv('INVALIDATION_BUS', '1') == '1'
+poll_interval = float(os.getenv('INVALIDATION_BUS_POLL_SECONDS', 0.05))
+retention_seconds = int(os.getenv('INVALIDATION_BUS_RETENTION_SECONDS', 300))
+compaction_interval = 60
+batch_size = 500
+
+
+class InvalidationBus:
+    # Workers share changes through the ChangeEvent table: publishing appends a row and every
+    # worker tails rows by id, applying the ones published by other workers to its own caches
+    def __init__(self):
+        self._handlers = {}
+        self._last_id = 0
+        self._task = None
+
+    def subscribe(self, channel, handler):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def _dispatch(self, channel, key):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(*key.split(':'))
+            except Exception:
+                logger.exception('Invalidation handler for %s %s failed', channel, key)
+
+    async def publish(self, channel, *parts, local=True):
+        key = ':'.join(map(str, parts))
+        if local:
+            self._dispatch(channel, key)
+        if bus_enabled:
+            await ChangeEvent.create(channel=channel, key=key, origin=worker_id, created_at=timezone.now())
+
+    async def _tail(self):
+        compacted_at = time.monotonic()
+        while True:
+            await asyncio.sleep(poll_interval)
+            try:
+                rows = await ChangeEvent.filter(id__gt=self._last_id).order_by('id').limit(batch_size). \
+                    values('id', 'channel', 'key', 'origin')
+                for row in rows:
+                    self._last_id = row['id']
+                    if row['origin'] != worker_id:
+                        self._dispatch(row['channel'], row['key'])
+                if time.monotonic() - compacted_at >= compaction_interval:
+                    compacted_at = time.monotonic()
+                    cutoff = timezone.now() - timedelta(seconds=retention_seconds)
+                    await ChangeEvent.filter(created_at__lt=cutoff).delete()
+            except Exception:
+                logger.exception('Tailing change events failed')
+
+    async def start(self):
+        if not bus_enabled:
+            return
+        latest = await ChangeEvent.all().order_by('-id').first().values('id')
+        self._last_id = latest['id'] if latest else 0
+        self._task = asyncio.create_task(self._tail())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+bus = InvalidationBus()
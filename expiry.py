@@ -0,0 +1,148 @@
+import asyncio
+import heapq
+import logging
+import os
+
+from tortoise import timezone
+from tortoise.expressions import Q
+
+from authentication import invalidate_user
+from metrics import Gauge, registry
+from models import Subscription, Tokens, User
+from pagination import keyset_stream
+
+TOKEN = 'token'
+SUBSCRIPTION = 'subscription'
+USER = 'user'
+
+logger = logging.getLogger('expiry')
+# Wall-clock deadlines are rechecked at least this often, so clock adjustments are picked up
+max_sleep_seconds = float(os.getenv('EXPIRY_MAX_SLEEP_SECONDS', 60))
+retry_seconds = float(os.getenv('EXPIRY_RETRY_SECONDS', 30))
+
+
+def _now():
+    # Deadlines come from aware datetimes stamped with timezone.now(), the heap uses the same clock
+    return timezone.now().timestamp()
+
+
+class ExpiryScheduler:
+    # A min-heap of (deadline, kind, key) with lazy deletion: _deadlines holds the current deadline of every
+    # item and heap entries that no longer match it are dropped when they reach the top. Every worker runs
+    # its own scheduler, the expiry queries are idempotent and recheck the deadline in SQL.
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}
+        self._wake = asyncio.Event()
+        self._task = None
+        self.active_users = set()
+
+    def is_active(self, user_id):
+        return str(user_id) in self.active_users
+
+    def pending(self):
+        return len(self._deadlines)
+
+    def schedule(self, kind, key, deadline):
+        key, deadline = str(key), float(deadline)
+        self._deadlines[(kind, key)] = deadline
+        heapq.heappush(self._heap, (deadline, kind, key))
+        if kind == USER:
+            if deadline > _now():
+                self.active_users.add(key)
+            else:
+                self.active_users.discard(key)
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(deadline, kind, key) for (kind, key), deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+        if self._heap[0][0] == deadline:
+            self._wake.set()
+
+    def _pop_due(self, now):
+        due = {TOKEN: [], SUBSCRIPTION: [], USER: []}
+        while self._heap and self._heap[0][0] <= now:
+            deadline, kind, key = heapq.heappop(self._heap)
+            if self._deadlines.get((kind, key)) == deadline:
+                del self._deadlines[(kind, key)]
+                due[kind].append(key)
+        return due
+
+    def _reschedule(self, kind, key, deadline):
+        # Only reached for rows whose stored deadline was moved, a past one means the clocks disagree
+        if deadline <= _now():
+            logger.warning('%s %s is still stored as live after its deadline', kind, key)
+            deadline = _now() + retry_seconds
+        self.schedule(kind, key, deadline)
+
+    async def _expire(self, due):
+        now = timezone.now()
+        if due[TOKEN]:
+            ids = [int(key) for key in due[TOKEN]]
+            await Tokens.filter(id__in=ids, expires__lte=now).delete()
+            for row in await Tokens.filter(id__in=ids).values('id', 'expires'):
+                self._reschedule(TOKEN, row['id'], row['expires'].timestamp())
+        if due[SUBSCRIPTION]:
+            ids = [int(key) for key in due[SUBSCRIPTION]]
+            await Subscription.filter(id__in=ids, expires__lte=now).delete()
+            for row in await Subscription.filter(id__in=ids).values('id', 'expires'):
+                self._reschedule(SUBSCRIPTION, row['id'], row['expires'].timestamp())
+        if due[USER]:
+            await User.filter(id__in=due[USER], role='moderator', subscription_expires__lte=now). \
+                update(role='user')
+            for key in due[USER]:
+                self.active_users.discard(key)
+                invalidate_user(key)
+            for row in await User.filter(id__in=due[USER], subscription_expires__gt=now). \
+                    values('id', 'subscription_expires'):
+                self._reschedule(USER, row['id'], row['subscription_expires'].timestamp())
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            delay = self._heap[0][0] - _now() if self._heap else max_sleep_seconds
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), min(delay, max_sleep_seconds))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            due = self._pop_due(_now())
+            try:
+                await self._expire(due)
+            except Exception:
+                logger.exception('Expiring %s failed', {kind: len(keys) for kind, keys in due.items()})
+                for kind, keys in due.items():
+                    for key in keys:
+                        self._deadlines.setdefault((kind, key), _now() + retry_seconds)
+                        heapq.heappush(self._heap, (self._deadlines[(kind, key)], kind, key))
+
+    async def load(self):
+        async for row in keyset_stream(Tokens.all(), ('id',), ('id', 'expires')):
+            self.schedule(TOKEN, row['id'], row['expires'].timestamp())
+        async for row in keyset_stream(Subscription.all(), ('id',), ('id', 'expires')):
+            self.schedule(SUBSCRIPTION, row['id'], row['expires'].timestamp())
+        # Moderators whose subscription ran out while no worker was up are downgraded on the first tick
+        now = timezone.now()
+        users = User.filter(Q(subscription_expires__gt=now) | Q(role='moderator', subscription_expires__lte=now))
+        async for row in keyset_stream(users, ('id',), ('id', 'subscription_expires')):
+            self.schedule(USER, row['id'], row['subscription_expires'].timestamp())
+
+    async def start(self):
+        await self.load()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+expiry_scheduler = ExpiryScheduler()
+registry.register(Gauge('expiry_scheduled', 'Tokens, subscriptions and users waiting to expire',
+                        lambda: {(): expiry_scheduler.pending()}))
+registry.register(Gauge('active_subscribers', 'Users with an unexpired subscription',
+                        lambda: {(): len(expiry_scheduler.active_users)}))
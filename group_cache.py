@@ -0,0 +1,40 @@
+import os
+
+from cache import TTLCache
+from models import Groups, Subjects
+
+# Subjects and group rows only change through a handful of endpoints that invalidate
+# precisely, so the TTL is only a safety net
+group_cache_size = int(os.getenv('GROUP_CACHE_SIZE', 1024))
+group_cache_ttl = int(os.getenv('GROUP_CACHE_TTL', 3600))
+subjects_cache = TTLCache(maxsize=group_cache_size, ttl=group_cache_ttl)
+groups_cache = TTLCache(maxsize=group_cache_size, ttl=group_cache_ttl)
+
+
+async def get_group_subjects(group_id):
+    subjects = subjects_cache.get(str(group_id))
+    if subjects is None:
+        subjects = await Subjects.all().order_by('subject_full_name'). \
+            filter(group_id=group_id).values('id', 'subject_full_name', 'subject_short_name')
+        subjects_cache.set(str(group_id), subjects)
+    return subjects
+
+
+async def get_group(group_id):
+    group = groups_cache.get(str(group_id))
+    if group is None:
+        group = await Groups.get(group_id=group_id)
+        groups_cache.set(str(group_id), group)
+    return group
+
+
+def invalidate_subjects(group_id):
+    subjects_cache.pop(str(group_id))
+
+
+def invalidate_group(group_id):
+    groups_cache.pop(str(group_id))
+
+
+def group_cache_stats():
+    return {'subjects': subjects_cache.stats(), 'groups': groups_cache.stats()}
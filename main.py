@@ -1,49 +1,98 @@
-import os
-from fastapi import FastAPI, HTTPException, Depends, status
+import asyncio
+import json
+from fastapi import FastAPI, HTTPException, Depends, status, WebSocket, WebSocketDisconnect, Request, Response, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from tortoise.contrib.fastapi import register_tortoise
-from models import User_Pydantic, UserIn_Pydantic, User, InfoQueue_Pydantic, InfoQueueIn_Pydantic, InfoQueue, \
-    Subjects_Pydantic, SubjectsIn_Pydantic, Subjects, Tokens_Pydantic, Tokens, Subscription, \
+from tortoise import connections, timezone
+from tortoise.exceptions import DoesNotExist, IntegrityError
+from tortoise.expressions import F
+from tortoise.transactions import in_transaction
+from models import User_Pydantic, UserIn_Pydantic, User, InfoQueue_Pydantic, InfoQueueIn_Pydantic, \
+    SubjectsIn_Pydantic, Subjects, Tokens_Pydantic, Tokens, Subscription, \
     Subscription_Pydantic, SubscriptionIn_Pydantic, UserOut_Pydantic, Groups, Groups_Pydantic, GroupsIn_Pydantic, \
-    SubjectsUpd_Pydantic
+    SubjectsUpd_Pydantic, QueueEntryRead, SubjectRead, UserNameRead, queue_entry_json, queue_entries_json, \
+    subjects_json, user_name_json, user_names_json
 from pydantic import BaseModel
-from fastapi_mail import FastMail, ConnectionConfig
 from starlette.exceptions import HTTPException
 from dotenv import load_dotenv
+from migrations import run_migrations
+from settings import TORTOISE_ORM, WRITE_CONNECTION
+from queue_engine import queue_engine
+from queue_events import queue_broadcaster
+from queue_stats import queue_stats
+from bus import bus
+from outbox import outbox
+from expiry import expiry_scheduler, TOKEN, SUBSCRIPTION, USER
+from cache import TTLCache
+from versions import versions
+from group_cache import get_group_subjects, get_group, invalidate_subjects, invalidate_group, group_cache_stats
+from pagination import STREAM_BATCH_SIZE, encode_cursor, decode_cursor, keyset_page, keyset_stream
 from authentication import get_hashed_password, authenticate_user, create_access_token, get_current_user, \
-    generate_invitation_token
-from typing import Annotated, List
-from datetime import datetime, timedelta
+    generate_invitation_token, invalidate_user, auth_cache_stats, password_metrics
+from ratelimit import limit_reads, limit_writes
+from metrics import MetricsMiddleware, Gauge, registry, install_query_hook, slow_request_seconds
+from typing import Annotated, List, Literal
+from uuid import UUID
+from datetime import timedelta
 from dateutil.relativedelta import relativedelta
 from fastapi.middleware.cors import CORSMiddleware
 
 load_dotenv()
-username = os.getenv('SECRET_EMAIL')
-password = os.getenv('SECRET_PASSWORD')
 app = FastAPI()
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+USER_ORDER = ('last_name', 'first_name', 'id')
+# Invitation tokens known to be exhausted or expired, answered without a transaction
+rejected_tokens = TTLCache(maxsize=1024, ttl=600)
+
+
+# Shutdown handlers run in registration order, so this one is registered ahead of register_tortoise:
+# the background tasks stop while the connections they use are still open
+@app.on_event('shutdown')
+async def stop_background_tasks():
+    await outbox.stop()
+    await expiry_scheduler.stop()
+    await bus.stop()
+    await queue_stats.stop()
+
 
-conf = ConnectionConfig(
-    MAIL_USERNAME=username,
-    MAIL_PASSWORD=password,
-    MAIL_FROM=username,
-    MAIL_PORT=587,
-    MAIL_SERVER="smtp.gmail.com",
-    MAIL_FROM_NAME="Team W8Whiz",
-    MAIL_STARTTLS=True,
-    MAIL_SSL_TLS=False,
-    USE_CREDENTIALS=True,
-    VALIDATE_CERTS=True
-)
-fast_mail = FastMail(conf)
 register_tortoise(
     app,
-    db_url='sqlite://db.sqlite3',
-    modules={"models": ["models"]},
-    generate_schemas=True,
+    config=TORTOISE_ORM,
     add_exception_handlers=True,
 )
 
+
+@app.on_event('startup')
+async def apply_migrations():
+    await run_migrations(WRITE_CONNECTION)
+
+
+@app.on_event('startup')
+async def instrument_queries():
+    install_query_hook(connections)
+
+
+@app.on_event('startup')
+async def start_queue_stats():
+    await queue_stats.start()
+
+
+@app.on_event('startup')
+async def start_bus():
+    await bus.start()
+
+
+@app.on_event('startup')
+async def start_expiry_scheduler():
+    await expiry_scheduler.start()
+
+
+@app.on_event('startup')
+async def start_outbox():
+    await outbox.start()
+
+
 origins = [
     'http://localhost:5173',
     'http://localhost:5173/',
@@ -61,6 +110,27 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+bus.subscribe('user', invalidate_user)
+bus.subscribe('members', lambda group_id: versions.bump('members', group_id))
+bus.subscribe('subjects', invalidate_subjects)
+bus.subscribe('subjects', lambda group_id: versions.bump('subjects', group_id))
+bus.subscribe('group', invalidate_group)
+bus.subscribe('group', lambda group_id: versions.bump('group', group_id))
+bus.subscribe('queue', queue_engine.invalidate)
+bus.subscribe('expiry', expiry_scheduler.schedule)
+app.add_middleware(MetricsMiddleware, router=app.router, slow_request_seconds=slow_request_seconds)
+registry.register(Gauge('auth_cache_hits', 'Auth cache hits',
+                        lambda: {(('cache', name),): stats['hits'] for name, stats in auth_cache_stats().items()}))
+registry.register(Gauge('auth_cache_misses', 'Auth cache misses',
+                        lambda: {(('cache', name),): stats['misses'] for name, stats in auth_cache_stats().items()}))
+registry.register(Gauge('group_cache_hits', 'Subject and group metadata cache hits',
+                        lambda: {(('cache', name),): stats['hits'] for name, stats in group_cache_stats().items()}))
+registry.register(Gauge('group_cache_misses', 'Subject and group metadata cache misses',
+                        lambda: {(('cache', name),): stats['misses'] for name, stats in group_cache_stats().items()}))
+registry.register(Gauge('password_jobs', 'Password hashing jobs by state',
+                        lambda: {(('state', name),): value for name, value in password_metrics.items()}))
+registry.register(Gauge('queue_subscribers', 'Open queue subscriptions',
+                        lambda: {(): queue_broadcaster.subscriber_count()}))
 
 
 class Token(BaseModel):
@@ -71,16 +141,108 @@ class Status(BaseModel):
     message: str
 
 
+class QueueOperation(BaseModel):
+    op: Literal['enqueue', 'dequeue', 'reorder', 'clear']
+    subject_number: UUID
+    user_id: UUID | None = None
+    task_number: int | None = None
+    order: List[UUID] = []
+
+
+class QueueBatch(BaseModel):
+    operations: List[QueueOperation]
+
+
+class QueueState(BaseModel):
+    subject_number: str
+    entries: List[InfoQueue_Pydantic]
+
+
+class QueueStatsOut(BaseModel):
+    window_hours: int
+    enqueued: int
+    completed: int
+    removed: int
+    average_wait_seconds: float | None
+    p50_wait_seconds: float | None
+    p90_wait_seconds: float | None
+    p99_wait_seconds: float | None
+    completed_last_hour: int
+    throughput_per_hour: float
+
+
+def check_etag(request, response, kind, *parts):
+    # The tag is taken before the read, so a write racing the read only costs the client one extra 200
+    # The resource follows from the caller's token, not only the URL, so caches must key on Authorization too
+    tag = versions.etag(kind, *parts, variant=request.url.query)
+    if tag in (candidate.strip() for candidate in request.headers.get('if-none-match', '').split(',')):
+        return Response(status_code=304, headers={'ETag': tag, 'Vary': 'Authorization'})
+    response.headers['ETag'] = tag
+    response.headers['Vary'] = 'Authorization'
+    return None
+
+
+def response_headers(response, next_cursor=None):
+    headers = {}
+    if response is not None and 'etag' in response.headers:
+        headers['ETag'] = response.headers['etag']
+        headers['Vary'] = response.headers['vary']
+    if next_cursor is not None:
+        headers['X-Next-Cursor'] = encode_cursor(next_cursor)
+    return headers
+
+
+def rows_response(adapter, rows, response=None, next_cursor=None):
+    # Rows are trusted DB projections, so they are dumped straight to JSON without response_model validation
+    return Response(adapter.dump_json(rows), media_type='application/json',
+                    headers=response_headers(response, next_cursor))
+
+
+def ndjson_response(adapter, rows, response=None):
+    async def lines():
+        async for row in rows:
+            yield adapter.dump_json(row) + b'\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson', headers=response_headers(response))
+
+
+async def check_subject(group_id, subject):
+    # Queues exist only for the caller's own subjects, so arbitrary ids never reach the queue engine
+    if not any(str(row['id']) == str(subject) for row in await get_group_subjects(group_id)):
+        raise HTTPException(status_code=404, detail='Предмет не найден')
+
+
+async def queue_rows(group_id, subject):
+    after = None
+    while True:
+        rows, after = await queue_engine.page(group_id, subject, after, STREAM_BATCH_SIZE)
+        for row in rows:
+            yield row
+        if after is None:
+            return
+
+
 @app.get("/")
 async def root():
     return {"message": "API"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return registry.render()
+
+
 @app.post("/registration", response_model=Token)
 async def create_user(user: UserIn_Pydantic):
     plain_password = user.password
     user.password = await get_hashed_password(user.password)
-    user_obj = await User.create(**user.model_dump(exclude_unset=True))
+    # The user and its verification email commit together, a failed outbox insert leaves no half registered user
+    async with in_transaction(WRITE_CONNECTION) as connection:
+        user_obj = await User.create(**user.model_dump(exclude_unset=True), using_db=connection)
+        verification_token_expires = timedelta(minutes=10)
+        verification_token = create_access_token(data={'sub': user_obj.email},
+                                                  expires_delta=verification_token_expires)
+        await send_verification_email(user_obj.email, verification_token, using_db=connection)
     user = await authenticate_user(user_obj.email, plain_password)
     if not user:
         raise HTTPException(
@@ -92,21 +254,14 @@ async def create_user(user: UserIn_Pydantic):
     access_token = create_access_token(
         data={"sub": user.email}, expires_delta=access_token_expires
     )
-    """
-    verification_token_expires = timedelta(minutes=10)
-    verification_token = create_access_token(data={'sub': user.email}, expires_delta=verification_token_expires)
-    await send_verification_email(user.email, verification_token)
-    """
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-"""
-async def send_verification_email(email: str, token: str):
-    message = MessageSchema(subject="Verify your email", recipients=[email],
-                            body=f"Click the link below to verify your email token: /{token}",
-                            subtype=MessageType.html)
-    await fast_mail.send_message(message)
-"""
+async def send_verification_email(email: str, token: str, using_db=None):
+    # Only writes the outbox row, the background worker does the SMTP delivery
+    await outbox.enqueue(recipients=[email], subject="Verify your email",
+                         body=f"Click the link below to verify your email token: /{token}", subtype='html',
+                         using_db=using_db)
 
 
 @app.get("/user/{user_id}", response_model=User_Pydantic)
@@ -116,9 +271,13 @@ async def get_user(user_id: int):
   
 @app.delete("/user/{user_id}", response_model=Status)
 async def delete_user(user_id: int):
+    group_ids = await User.filter(id=user_id).values_list('group_id', flat=True)
     deleted_count = await User.filter(id=user_id).delete()
     if not deleted_count:
         raise HTTPException(status_code=404, detail=f"User {user_id} not found")
+    await bus.publish('user', user_id)
+    for group_id in group_ids:
+        await bus.publish('members', group_id)
     return Status(message=f"Deleted user {user_id}")
 
 
@@ -143,78 +302,146 @@ async def read_users_me(current_user: User_Pydantic = Depends(get_current_user))
     return current_user
 
 
-@app.post("/infoqueue/add_to_queue/", response_model=List[InfoQueue_Pydantic])
+@app.post("/infoqueue/add_to_queue/", response_model=List[QueueEntryRead], dependencies=[Depends(limit_writes)])
 async def add_to_queue(remaining_inf: InfoQueueIn_Pydantic, current_user: User_Pydantic = Depends(get_current_user)):
     current_id = current_user.id
     subj = remaining_inf.subject_number
     current_group = current_user.group_id
-    position = 1
-    existing_entry = await InfoQueue.filter(user_id=current_id, subject_number=subj, group_id=current_group).first()
-    if existing_entry:
-        raise HTTPException(status_code=400, detail='User is already in queue')
     task = remaining_inf.task_number
     user_fname = current_user.first_name
     user_lname = current_user.last_name
-    await InfoQueue.create(user_id=current_id, position=position, group_id=current_group, first_name=user_fname,
-                           last_name=user_lname,
-                           task_number=task, subject_number=subj)
-    return await InfoQueue.all().order_by('created_at',
-                                          'task_number').filter(subject_number=subj,
-                                                                group_id=current_group).only('position',
-                                                                                             'task_number',
-                                                                                             'first_name',
-                                                                                             'last_name').values()
-
-
-@app.get('/infoqueue/get_queue/{subject}', response_model=List[InfoQueue_Pydantic])
-async def get_queue(subject: str, current_user: User_Pydantic = Depends(get_current_user)):
-    return await InfoQueue.all().order_by('created_at',
-                                          'task_number'). \
-        filter(subject_number=subject,
-               group_id=current_user.group_id).only('position',
-                                                    'task_number',
-                                                    'first_name',
-                                                    'last_name').values()
-
-
-@app.delete('/infoqueue/complete/{subject}', response_model=List[InfoQueue_Pydantic])
-async def complete_queue(subject: str, current_user: User_Pydantic = Depends(get_current_user)):
+    await check_subject(current_group, subj)
+    queued = await queue_engine.enqueue(current_group, subj, current_id, first_name=user_fname, last_name=user_lname,
+                                        task_number=task)
+    if not queued:
+        raise HTTPException(status_code=400, detail='User is already in queue')
+    return rows_response(queue_entries_json, await queue_engine.snapshot(current_group, subj))
+
+
+@app.get('/infoqueue/get_queue/{subject}', response_model=List[QueueEntryRead], dependencies=[Depends(limit_reads)])
+async def get_queue(subject: UUID, request: Request, response: Response,
+                    limit: Annotated[int | None, Query(ge=1, le=500)] = None, cursor: str | None = None,
+                    stream: bool = False, current_user: User_Pydantic = Depends(get_current_user)):
+    await check_subject(current_user.group_id, subject)
+    not_modified = check_etag(request, response, 'queue', *queue_engine.key(current_user.group_id, subject))
+    if not_modified:
+        return not_modified
+    if stream:
+        return ndjson_response(queue_entry_json, queue_rows(current_user.group_id, subject), response)
+    if limit is None:
+        return rows_response(queue_entries_json, await queue_engine.snapshot(current_user.group_id, subject),
+                             response)
+    after = decode_cursor(cursor, (float, int, int)) if cursor else None
+    if after is not None and None in after:
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+    rows, next_cursor = await queue_engine.page(current_user.group_id, subject, after, limit)
+    return rows_response(queue_entries_json, rows, response, next_cursor)
+
+
+@app.delete('/infoqueue/complete/{subject}', response_model=List[QueueEntryRead], dependencies=[Depends(limit_writes)])
+async def complete_queue(subject: UUID, current_user: User_Pydantic = Depends(get_current_user)):
+    await check_subject(current_user.group_id, subject)
     current_last_name = current_user.last_name
     current_id = current_user.id
-    end_queue = await InfoQueue.filter(user_id=current_id,
-                                       subject_number=subject).delete()
+    end_queue = await queue_engine.dequeue(current_user.group_id, subject, current_id)
     if not end_queue:
         raise HTTPException(status_code=404, detail=f"{current_last_name} not found")
-    return await InfoQueue.all().order_by('position'). \
-        filter(subject_number=subject,
-               group_id=current_user.group_id).only('position',
-                                                    'task_number',
-                                                    'first_name',
-                                                    'last_name').values()
-
-
-@app.get('/infoqueue/get_subjects/', response_model=List[Subjects_Pydantic])
-async def get_subjects(current_user: User_Pydantic = Depends(get_current_user)):
-    return await Subjects.all().order_by('subject_full_name'). \
-        filter(group_id=current_user.group_id).only('subject_full_name',
-                                                    'subject_short_name').values()
-
-
-@app.post('/infoqueue/add_new_subjects/', response_model=List[Subjects_Pydantic])
+    return rows_response(queue_entries_json, await queue_engine.snapshot(current_user.group_id, subject))
+
+
+@app.post('/infoqueue/bulk/', response_model=List[QueueState], dependencies=[Depends(limit_writes)])
+async def bulk_queue_operations(batch: QueueBatch, current_user: User_Pydantic = Depends(get_current_user)):
+    if current_user.role != 'moderator' or not expiry_scheduler.is_active(current_user.id):
+        raise HTTPException(status_code=403, detail='Доступно только модераторам')
+    for operation in batch.operations:
+        if operation.op in ('enqueue', 'dequeue') and operation.user_id is None:
+            raise HTTPException(status_code=422, detail=f'{operation.op} requires user_id')
+        if operation.op == 'enqueue' and operation.task_number is None:
+            raise HTTPException(status_code=422, detail='enqueue requires task_number')
+    if not batch.operations:
+        return []
+    for subject in {operation.subject_number for operation in batch.operations}:
+        await check_subject(current_user.group_id, subject)
+    enqueued = {operation.user_id for operation in batch.operations if operation.op == 'enqueue'}
+    members = {}
+    if enqueued:
+        members = {row['id']: row for row in await User.filter(id__in=enqueued, group_id=current_user.group_id).
+                   values('id', 'first_name', 'last_name')}
+    missing = enqueued - members.keys()
+    if missing:
+        raise HTTPException(status_code=404, detail=f'Users {", ".join(map(str, missing))} are not in your group')
+    try:
+        states = await queue_engine.apply_batch(current_user.group_id, batch.operations, members)
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail='Queue changed concurrently, retry the batch')
+    return [QueueState(subject_number=subject, entries=entries) for subject, entries in states.items()]
+
+
+@app.get('/infoqueue/stats/{subject}', response_model=QueueStatsOut, dependencies=[Depends(limit_reads)])
+async def get_queue_stats(subject: UUID, current_user: User_Pydantic = Depends(get_current_user)):
+    await check_subject(current_user.group_id, subject)
+    return queue_stats.summary(queue_engine.key(current_user.group_id, subject))
+
+
+@app.websocket('/infoqueue/subscribe/{subject}')
+async def subscribe_queue(websocket: WebSocket, subject: UUID, token: str):
+    try:
+        current_user = await get_current_user(token)
+        await check_subject(current_user.group_id, subject)
+    except (HTTPException, DoesNotExist):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+
+    async def send_updates():
+        async for message in queue_broadcaster.updates(current_user.group_id, subject):
+            await websocket.send_json(message)
+
+    sender = asyncio.create_task(send_updates())
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+
+
+@app.get('/infoqueue/events/{subject}')
+async def queue_events(subject: UUID, current_user: User_Pydantic = Depends(get_current_user)):
+    await check_subject(current_user.group_id, subject)
+    async def event_stream():
+        async for message in queue_broadcaster.updates(current_user.group_id, subject):
+            yield f"event: {message['type']}\ndata: {json.dumps(message)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type='text/event-stream')
+
+
+@app.get('/infoqueue/get_subjects/', response_model=List[SubjectRead], dependencies=[Depends(limit_reads)])
+async def get_subjects(request: Request, response: Response,
+                       current_user: User_Pydantic = Depends(get_current_user)):
+    not_modified = check_etag(request, response, 'subjects', current_user.group_id)
+    if not_modified:
+        return not_modified
+    return rows_response(subjects_json, await get_group_subjects(current_user.group_id), response)
+
+
+@app.post('/infoqueue/add_new_subjects/', response_model=List[SubjectRead])
 async def add_new_subjects(subjects_info: SubjectsIn_Pydantic,
                            current_user: User_Pydantic = Depends(get_current_user)):
     current_group = current_user.group_id
     subjects_full_name = subjects_info.subject_full_name
     subjects_short_name = subjects_info.subject_short_name
-    existing_subject = await Subjects.filter(group_id=current_group, subject_full_name=subjects_full_name,
-                                             subject_short_name=subjects_short_name)
+    existing_subject = any(subject['subject_full_name'] == subjects_full_name and
+                           subject['subject_short_name'] == subjects_short_name
+                           for subject in await get_group_subjects(current_group))
     if existing_subject:
         raise HTTPException(status_code=400, detail=f'{subjects_full_name} already exists')
     else:
         await Subjects.create(group_id=current_group, subject_full_name=subjects_full_name,
                               subject_short_name=subjects_short_name)
-    return await Subjects.all().filter(group_id=current_group).only('subject_full_name',
-                                                                    'subject_short_name').values()
+        await bus.publish('subjects', current_group)
+    return rows_response(subjects_json, await get_group_subjects(current_group))
 
 
 @app.post('/infoqueue/update_subject', response_model=Status)
@@ -223,6 +450,7 @@ async def update_subject(subject_upd: SubjectsUpd_Pydantic, current_user: User_P
     current_subject.subject_short_name = subject_upd.subject_short_name
     current_subject.subject_full_name = subject_upd.subject_full_name
     await current_subject.save()
+    await bus.publish('subjects', current_subject.group_id)
     return Status(message='Предмет был успешно обновлен')
 
 
@@ -236,11 +464,14 @@ async def get_subscription_plan(current_user: User_Pydantic = Depends(get_curren
 
 @app.get('/user/generate_invitation_token/', response_model=Tokens_Pydantic)
 async def create_invitation_token(current_user: User_Pydantic = Depends(get_current_user)):
+    if not expiry_scheduler.is_active(current_user.id):
+        raise HTTPException(status_code=403, detail='Подписка не активна')
     subscription_plan = await Subscription_Pydantic.from_queryset_single(Subscription.get(owner_id=current_user.id))
     new_token = generate_invitation_token()
-    await Tokens.create(group_id=subscription_plan.group_id,
-                        remaining_activations=subscription_plan.group_population,
-                        token=new_token, owner_id=subscription_plan.owner_id, expires=subscription_plan.expires)
+    token = await Tokens.create(group_id=subscription_plan.group_id,
+                                remaining_activations=subscription_plan.group_population,
+                                token=new_token, owner_id=subscription_plan.owner_id, expires=subscription_plan.expires)
+    await bus.publish('expiry', TOKEN, token.id, token.expires.timestamp())
     return await Tokens_Pydantic.from_queryset_single(Tokens.get(group_id=subscription_plan.group_id))
 
 
@@ -257,37 +488,54 @@ async def activate_subscription(subscription_info: SubscriptionIn_Pydantic, grou
         user = await User.get(id=current_user.id)
         user.group_id = new_group.group_id
         await user.save()
+        await bus.publish('user', current_user.id)
+        await bus.publish('members', new_group.group_id)
     existing_subscription = await Subscription.filter(owner_id=current_user.group_id)
     if existing_subscription:
         raise HTTPException(status_code=400, detail='Ваша подписка уже активна')
-    current_datetime = datetime.now()
+    current_datetime = timezone.now()
     expires = current_datetime + relativedelta(months=+subscription_info.months)
     user = await User.get(id=current_user.id)
-    await Subscription.create(tier=subscription_info.tier, owner_id=current_user.id,
-                              group_population=subscription_info.group_population,
-                              expires=expires, created_at=current_datetime, group_id=user.group_id,
-                              months=subscription_info.months)
+    subscription = await Subscription.create(tier=subscription_info.tier, owner_id=current_user.id,
+                                             group_population=subscription_info.group_population,
+                                             expires=expires, created_at=current_datetime,
+                                             group_id=user.group_id, months=subscription_info.months)
     user = await User.get(id=current_user.id)
     user.role = 'moderator'
     user.subscription_expires = expires
     await user.save()
+    await bus.publish('user', current_user.id)
+    await bus.publish('members', user.group_id)
+    await bus.publish('expiry', SUBSCRIPTION, subscription.id, expires.timestamp())
+    await bus.publish('expiry', USER, current_user.id, expires.timestamp())
     return Status(message='Ваша подписка успешно активирована')
 
 
 @app.post('/user/enter_invitation_token/{token}', response_model=Status)
 async def enter_invitation_token(token: str, current_user: User_Pydantic = Depends(get_current_user)):
+    rejection = rejected_tokens.get(token)
+    if rejection is not None:
+        raise HTTPException(status_code=400, detail=rejection)
     token_info = await Tokens.get(token=token)
-    current_time = datetime.now()
-    user = await User.get(id=current_user.id)
-    if token_info.remaining_activations == 0:
-        raise HTTPException(status_code=400, detail='Превышен лимит активаций!')
-    else:
-        if current_user.group_id is None:
-            user.group_id = token_info.group_id
-            user.subscription_expires = token_info.expires
-            await user.save()
-        token_info.remaining_activations -= 1
-        await token_info.save()
+    # The group assignment and the decrement commit together, raising rolls both back. SQLite opens the
+    # transaction deferred, so its first statement is a write: a transaction that read first could not upgrade
+    # to a writer once another worker had committed, and would fail at once with "database is locked"
+    async with in_transaction(WRITE_CONNECTION) as connection:
+        joined = await User.filter(id=current_user.id, group_id__isnull=True).using_db(connection). \
+            update(group_id=token_info.group_id, subscription_expires=token_info.expires)
+        if not joined:
+            raise HTTPException(status_code=400, detail='Вы уже состоите в группе')
+        redeemed = await Tokens.filter(id=token_info.id, remaining_activations__gt=0,
+                                       expires__gt=timezone.now()).using_db(connection). \
+            update(remaining_activations=F('remaining_activations') - 1)
+        if not redeemed:
+            rejection = 'Превышен лимит активаций!' if token_info.remaining_activations <= 0 \
+                else 'Срок действия приглашения истек'
+            rejected_tokens.set(token, rejection)
+            raise HTTPException(status_code=400, detail=rejection)
+    await bus.publish('user', current_user.id)
+    await bus.publish('members', token_info.group_id)
+    await bus.publish('expiry', USER, current_user.id, token_info.expires.timestamp())
 
     return Status(message=f'Вы успешно добавлены в группу {token_info.group_id}, ваша подписка активна')
 
@@ -300,14 +548,33 @@ async def set_group_number(group_info: GroupsIn_Pydantic, current_user: User_Pyd
         user = await User.get(id=current_user.id)
         user.group_id = new_group.group_id
         await user.save()
-    return await Groups.get(group_id=new_group.group_id)
-
-
-@app.get('/users/list_of_users/', response_model=List[User_Pydantic])
-async def get_list_of_users(current_user: User_Pydantic = Depends(get_current_user)):
-    return await User.filter(group_id=current_user.group_id).only('first_name', 'last_name').values()
-
-
-@app.get('/groups/get_group_number/', response_model=Groups_Pydantic)
-async def get_group_number(current_user: User_Pydantic = Depends(get_current_user)):
-    return await Groups.get(group_id=current_user.group_id)
+        await bus.publish('user', current_user.id)
+        await bus.publish('members', new_group.group_id)
+    await bus.publish('group', new_group.group_id)
+    return new_group
+
+
+@app.get('/users/list_of_users/', response_model=List[UserNameRead], dependencies=[Depends(limit_reads)])
+async def get_list_of_users(request: Request, response: Response,
+                            limit: Annotated[int | None, Query(ge=1, le=500)] = None, cursor: str | None = None,
+                            stream: bool = False, current_user: User_Pydantic = Depends(get_current_user)):
+    not_modified = check_etag(request, response, 'members', current_user.group_id)
+    if not_modified:
+        return not_modified
+    members = User.filter(group_id=current_user.group_id)
+    if stream:
+        return ndjson_response(user_name_json, keyset_stream(members, USER_ORDER, USER_ORDER), response)
+    if limit is None:
+        return rows_response(user_names_json, await members.values('first_name', 'last_name'), response)
+    after = decode_cursor(cursor, (str, str, str)) if cursor else None
+    rows, next_cursor = await keyset_page(members, USER_ORDER, USER_ORDER, after, limit)
+    return rows_response(user_names_json, rows, response, next_cursor)
+
+
+@app.get('/groups/get_group_number/', response_model=Groups_Pydantic, dependencies=[Depends(limit_reads)])
+async def get_group_number(request: Request, response: Response,
+                           current_user: User_Pydantic = Depends(get_current_user)):
+    not_modified = check_etag(request, response, 'group', current_user.group_id)
+    if not_modified:
+        return not_modified
+    return await get_group(current_user.group_id)
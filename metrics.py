@@ -0,0 +1,203 @@
+import contextvars
+import functools
+import logging
+import os
+import time
+
+from starlette.routing import Match
+
+logger = logging.getLogger('metrics')
+slow_request_seconds = float(os.environ['SLOW_REQUEST_MS']) / 1000 if os.getenv('SLOW_REQUEST_MS') else None
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+QUERY_METHODS = ('execute_query', 'execute_query_dict', 'execute_insert', 'execute_many', 'execute_script')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{_labels(key)} {value}' for key, value in self._values.items())
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series['buckets'][index] += 1
+                break
+        series['sum'] += value
+        series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['buckets']):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(key + (("le", bound),))} {cumulative}')
+            lines.append(f'{self.name}_bucket{_labels(key + (("le", "+Inf"),))} {series["count"]}')
+            lines.append(f'{self.name}_sum{_labels(key)} {series["sum"]}')
+            lines.append(f'{self.name}_count{_labels(key)} {series["count"]}')
+        return lines
+
+
+class Gauge:
+    # Read from a callback at scrape time, collect returns {((label, value), ...): value}
+    def __init__(self, name, description, collect):
+        self.name = name
+        self.description = description
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} gauge']
+        lines.extend(f'{self.name}{_labels(key)} {value}' for key, value in self.collect().items())
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+request_seconds = registry.register(Histogram('http_request_duration_seconds', 'Request latency by route'))
+requests_total = registry.register(Counter('http_requests_total', 'Requests by route, method and status'))
+db_queries_per_request = registry.register(Histogram('db_queries_per_request', 'DB queries issued per request',
+                                                     QUERY_BUCKETS))
+db_seconds_per_request = registry.register(Histogram('db_query_seconds_per_request',
+                                                     'Time spent in DB queries per request'))
+db_query_seconds = registry.register(Histogram('db_query_duration_seconds', 'Latency of single DB queries'))
+password_seconds = registry.register(Histogram('password_hash_duration_seconds',
+                                               'Time spent hashing or verifying passwords'))
+jwt_decode_seconds = registry.register(Histogram('jwt_decode_duration_seconds', 'Time spent decoding JWTs'))
+
+
+class RequestStats:
+    # Scopes nest, a query counts toward the innermost scope and every parent of it
+    __slots__ = ('queries', 'query_seconds', 'statements', 'parent')
+
+    def __init__(self, capture, parent=None):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.statements = [] if capture else None
+        self.parent = parent
+
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+def install_query_hook(connections):
+    # Tortoise has no query hook, so the query methods of every client class in use are wrapped once
+    def wrap(method):
+        @functools.wraps(method)
+        async def timed(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                db_query_seconds.observe(elapsed)
+                stats = current_request.get()
+                while stats is not None:
+                    stats.queries += 1
+                    stats.query_seconds += elapsed
+                    if stats.statements is not None and args:
+                        stats.statements.append(f'{elapsed * 1000:.2f}ms {args[0]}')
+                    stats = stats.parent
+
+        timed.metrics_wrapped = True
+        return timed
+
+    classes = set()
+    pending = [type(connection) for connection in connections.all()]
+    while pending:
+        cls = pending.pop()
+        if cls not in classes:
+            classes.add(cls)
+            pending.extend(cls.__subclasses__())
+    for cls in classes:
+        for name in QUERY_METHODS:
+            method = cls.__dict__.get(name)
+            if method is not None and not getattr(method, 'metrics_wrapped', False):
+                setattr(cls, name, wrap(method))
+
+
+class MetricsMiddleware:
+    def __init__(self, app, router, slow_request_seconds=None):
+        self.app = app
+        self.router = router
+        self.slow_request_seconds = slow_request_seconds
+
+    def route_of(self, scope):
+        for route in self.router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        route = self.route_of(scope)
+        method = scope['method']
+        stats = RequestStats(capture=self.slow_request_seconds is not None, parent=current_request.get())
+        token = current_request.set(stats)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            request_seconds.observe(elapsed, route=route, method=method)
+            requests_total.inc(route=route, method=method, status=status_code)
+            db_queries_per_request.observe(stats.queries, route=route)
+            db_seconds_per_request.observe(stats.query_seconds, route=route)
+            if self.slow_request_seconds is not None and elapsed >= self.slow_request_seconds:
+                logger.warning('Slow request %s %s took %.1fms with %d queries (%.1fms):\n%s', method, route,
+                               elapsed * 1000, stats.queries, stats.query_seconds * 1000,
+                               '\n'.join(stats.statements))
@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+from tortoise import Tortoise, connections
+from tortoise.exceptions import IntegrityError, OperationalError
+from tortoise.transactions import in_transaction
+
+# A lock row older than this was left behind by a worker that died while migrating
+LOCK_TIMEOUT_SECONDS = 600
+
+
+async def create_missing_tables(connection):
+    await Tortoise.generate_schemas(safe=True)
+
+
+async def add_queue_sort_column(connection):
+    # Databases created after the column was added to the model already got it from 0001_initial_schema.
+    # The column is qualified because SQLite reads an unknown quoted name as a string literal
+    try:
+        await connection.execute_query('SELECT "infoqueue"."sort_at" FROM "infoqueue" LIMIT 1')
+    except OperationalError:
+        await connection.execute_query('ALTER TABLE "infoqueue" ADD COLUMN "sort_at" TIMESTAMP')
+
+
+# Applied in order, each exactly once. A step is either a coroutine function taking the connection that
+# runs outside a transaction or a list of SQL statements applied in one transaction.
+MIGRATIONS = [
+    ('0001_initial_schema', create_missing_tables),
+    ('0002_hot_path_indexes', [
+        'DELETE FROM "infoqueue" WHERE "id" NOT IN '
+        '(SELECT MIN("id") FROM "infoqueue" GROUP BY "user_id", "subject_number", "group_id")',
+        'CREATE UNIQUE INDEX IF NOT EXISTS "uid_infoqueue_user_subject_group" '
+        'ON "infoqueue" ("user_id", "subject_number", "group_id")',
+        'CREATE INDEX IF NOT EXISTS "idx_infoqueue_subject_group_order" '
+        'ON "infoqueue" ("subject_number", "group_id", "created_at", "task_number")',
+        'CREATE INDEX IF NOT EXISTS "idx_subjects_group_name" ON "subjects" ("group_id", "subject_full_name")',
+        'CREATE INDEX IF NOT EXISTS "idx_user_group" ON "user" ("group_id")',
+        'CREATE INDEX IF NOT EXISTS "idx_tokens_token" ON "tokens" ("token")',
+        'CREATE INDEX IF NOT EXISTS "idx_tokens_group" ON "tokens" ("group_id")',
+        'CREATE INDEX IF NOT EXISTS "idx_subscription_owner" ON "subscription" ("owner_id")',
+    ]),
+    ('0003_queue_event_table', create_missing_tables),
+    ('0004_queue_event_indexes', [
+        'CREATE INDEX IF NOT EXISTS "idx_queueevent_created" ON "queueevent" ("created_at")',
+    ]),
+    ('0005_change_event_table', create_missing_tables),
+    ('0006_change_event_indexes', [
+        'CREATE INDEX IF NOT EXISTS "idx_changeevent_created" ON "changeevent" ("created_at")',
+    ]),
+    ('0007_outbox_email_table', create_missing_tables),
+    ('0008_outbox_email_indexes', [
+        'CREATE INDEX IF NOT EXISTS "idx_outboxemail_due" ON "outboxemail" ("status", "next_attempt_at")',
+        'CREATE INDEX IF NOT EXISTS "idx_outboxemail_claim" ON "outboxemail" ("claimed_by")',
+    ]),
+    ('0009_infoqueue_sort_column', add_queue_sort_column),
+    ('0010_infoqueue_sort_order', [
+        'UPDATE "infoqueue" SET "sort_at" = "created_at" WHERE "sort_at" IS NULL',
+        'DROP INDEX IF EXISTS "idx_infoqueue_subject_group_order"',
+        'CREATE INDEX IF NOT EXISTS "idx_infoqueue_subject_group_sort" '
+        'ON "infoqueue" ("subject_number", "group_id", "sort_at", "task_number")',
+    ]),
+]
+
+
+async def acquire_lock(connection):
+    # Every worker migrates at startup, the single row of schema_migrations_lock lets only one of them at a time
+    while True:
+        try:
+            await connection.execute_query(f'DELETE FROM "schema_migrations_lock" '
+                                           f'WHERE "locked_at" < {int(time.time()) - LOCK_TIMEOUT_SECONDS}')
+            await connection.execute_query(f'INSERT INTO "schema_migrations_lock" ("id", "locked_at") '
+                                           f'VALUES (1, {int(time.time())})')
+            return
+        except IntegrityError:
+            pass
+        except OperationalError as error:
+            if 'locked' not in str(error):
+                raise
+        await asyncio.sleep(0.1)
+
+
+async def release_lock(connection):
+    await connection.execute_query('DELETE FROM "schema_migrations_lock" WHERE "id" = 1')
+
+
+async def run_migrations(connection_name='default'):
+    connection = connections.get(connection_name)
+    await connection.execute_script('CREATE TABLE IF NOT EXISTS "schema_migrations" ('
+                                    '"name" VARCHAR(255) NOT NULL PRIMARY KEY, '
+                                    '"applied_at" TIMESTAMP NOT NULL)')
+    await connection.execute_script('CREATE TABLE IF NOT EXISTS "schema_migrations_lock" ('
+                                    '"id" INT NOT NULL PRIMARY KEY, '
+                                    '"locked_at" BIGINT NOT NULL)')
+    await acquire_lock(connection)
+    try:
+        await apply_pending(connection, connection_name)
+    finally:
+        await release_lock(connection)
+
+
+async def apply_pending(connection, connection_name):
+    applied = {row['name'] for row in await connection.execute_query_dict('SELECT "name" FROM "schema_migrations"')}
+    for name, steps in MIGRATIONS:
+        if name in applied:
+            continue
+        if callable(steps):
+            await steps(connection)
+            await connection.execute_query(f'INSERT INTO "schema_migrations" ("name", "applied_at") '
+                                           f"VALUES ('{name}', CURRENT_TIMESTAMP)")
+            continue
+        async with in_transaction(connection_name) as transaction:
+            for statement in steps:
+                await transaction.execute_query(statement)
+            await transaction.execute_query(f'INSERT INTO "schema_migrations" ("name", "applied_at") '
+                                            f"VALUES ('{name}', CURRENT_TIMESTAMP)")
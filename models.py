@@ -1,5 +1,10 @@
+from typing import List, Optional
+from uuid import UUID
+
+from pydantic import TypeAdapter
 from tortoise import fields, models
 from tortoise.contrib.pydantic import pydantic_model_creator
+from typing_extensions import TypedDict
 
 
 class User(models.Model):
@@ -26,6 +31,7 @@ class InfoQueue(models.Model):
     task_number = fields.IntField()
     subject_number = fields.UUIDField()
     created_at = fields.DatetimeField(auto_now_add=True)
+    sort_at = fields.DatetimeField(null=True)
     modified_at = fields.DatetimeField(auto_now=True)
 
     class PydanticMeta:
@@ -62,6 +68,39 @@ class Groups(models.Model):
     group_id = fields.UUIDField(pk=True, auto_generate=True)
 
 
+class QueueEvent(models.Model):
+    id = fields.BigIntField(pk=True)
+    group_id = fields.UUIDField()
+    subject_number = fields.UUIDField()
+    user_id = fields.UUIDField()
+    kind = fields.SmallIntField()
+    wait_seconds = fields.FloatField(null=True)
+    created_at = fields.DatetimeField()
+
+
+class ChangeEvent(models.Model):
+    id = fields.BigIntField(pk=True)
+    channel = fields.CharField(max_length=20)
+    key = fields.CharField(max_length=100)
+    origin = fields.CharField(max_length=16)
+    created_at = fields.DatetimeField()
+
+
+class OutboxEmail(models.Model):
+    id = fields.BigIntField(pk=True)
+    recipients = fields.JSONField()
+    subject = fields.CharField(max_length=255)
+    body = fields.TextField()
+    subtype = fields.CharField(max_length=10, default='html')
+    status = fields.CharField(max_length=10, default='pending')
+    attempts = fields.IntField(default=0)
+    next_attempt_at = fields.DatetimeField()
+    claimed_by = fields.CharField(max_length=16, null=True)
+    last_error = fields.TextField(null=True)
+    created_at = fields.DatetimeField()
+    sent_at = fields.DatetimeField(null=True)
+
+
 User_Pydantic = pydantic_model_creator(User, name="User")
 UserOut_Pydantic = pydantic_model_creator(User, name='UserOut', exclude=('password', 'created_at'))
 UserIn_Pydantic = pydantic_model_creator(User, name="UserIn", exclude_readonly=True, exclude=('created_at',
@@ -71,6 +110,7 @@ UserIn_Pydantic = pydantic_model_creator(User, name="UserIn", exclude_readonly=T
 InfoQueue_Pydantic = pydantic_model_creator(InfoQueue, name='InfoQueue')
 InfoQueueIn_Pydantic = pydantic_model_creator(InfoQueue, name="InfoQueueIn", exclude_readonly=True,
                                               exclude=('created_at',
+                                                       'sort_at',
                                                        'modified_at',
                                                        'first_name',
                                                        'last_name',
@@ -91,3 +131,30 @@ SubscriptionIn_Pydantic = pydantic_model_creator(Subscription, name="Subscriptio
 
 Groups_Pydantic = pydantic_model_creator(Groups, name="Groups")
 GroupsIn_Pydantic = pydantic_model_creator(Groups, name="GroupsIn", exclude_readonly=True, exclude=('group_id',))
+
+
+# Read schemas for list endpoints, matching exactly the columns those endpoints select.
+# Rows are dumped straight to JSON bytes by the adapters, without building models first.
+class QueueEntryRead(TypedDict):
+    position: int
+    task_number: int
+    first_name: Optional[str]
+    last_name: Optional[str]
+
+
+class SubjectRead(TypedDict):
+    id: UUID
+    subject_full_name: Optional[str]
+    subject_short_name: Optional[str]
+
+
+class UserNameRead(TypedDict):
+    first_name: Optional[str]
+    last_name: Optional[str]
+
+
+queue_entry_json = TypeAdapter(QueueEntryRead)
+queue_entries_json = TypeAdapter(List[QueueEntryRead])
+subjects_json = TypeAdapter(List[SubjectRead])
+user_name_json = TypeAdapter(UserNameRead)
+user_names_json = TypeAdapter(List[UserNameRead])
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import os
+import secrets
+import time
+from datetime import timedelta
+
+from dotenv import load_dotenv
+from fastapi_mail import ConnectionConfig, MessageSchema, MessageType
+from fastapi_mail.connection import Connection
+from fastapi_mail.msg import MailMsg
+from tortoise import timezone
+
+from metrics import Counter, registry
+from models import OutboxEmail
+from ratelimit import TokenBucketLimiter
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+load_dotenv()
+logger = logging.getLogger('outbox')
+username = os.getenv('SECRET_EMAIL')
+# Point MAIL_SERVER/MAIL_PORT at a local SMTP sink with MAIL_STARTTLS=0 and MAIL_USE_CREDENTIALS=0 to test delivery
+mail_config = ConnectionConfig(
+    MAIL_USERNAME=username,
+    MAIL_PASSWORD=os.getenv('SECRET_PASSWORD', ''),
+    MAIL_FROM=username,
+    MAIL_PORT=int(os.getenv('MAIL_PORT', 587)),
+    MAIL_SERVER=os.getenv('MAIL_SERVER', 'smtp.gmail.com'),
+    MAIL_FROM_NAME="Team W8Whiz",
+    MAIL_STARTTLS=os.getenv('MAIL_STARTTLS', '1') == '1',
+    MAIL_SSL_TLS=os.getenv('MAIL_SSL_TLS', '0') == '1',
+    USE_CREDENTIALS=os.getenv('MAIL_USE_CREDENTIALS', '1') == '1',
+    VALIDATE_CERTS=os.getenv('MAIL_VALIDATE_CERTS', '1') == '1',
+    SUPPRESS_SEND=int(os.getenv('MAIL_SUPPRESS_SEND', 0)),
+)
+poll_interval = float(os.getenv('OUTBOX_POLL_SECONDS', 5))
+batch_delay = float(os.getenv('OUTBOX_BATCH_DELAY_SECONDS', 0.5))
+batch_size = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+claim_seconds = int(os.getenv('OUTBOX_CLAIM_SECONDS', 300))
+max_attempts = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 8))
+retry_base_seconds = float(os.getenv('OUTBOX_RETRY_BASE_SECONDS', 30))
+retry_max_seconds = float(os.getenv('OUTBOX_RETRY_MAX_SECONDS', 3600))
+retention_days = int(os.getenv('OUTBOX_RETENTION_DAYS', 7))
+stop_timeout = float(os.getenv('OUTBOX_STOP_TIMEOUT_SECONDS', 10))
+compaction_interval = 3600
+send_limiter = TokenBucketLimiter(rate=float(os.getenv('OUTBOX_SEND_PER_SECOND', 2)),
+                                  burst=int(os.getenv('OUTBOX_SEND_BURST', 20)), max_keys=1)
+outbox_emails = registry.register(Counter('outbox_emails_total', 'Outbox deliveries by result'))
+
+
+class Outbox:
+    # Rows are claimed by stamping claimed_by and pushing next_attempt_at past the claim window, so several
+    # workers can drain the same table and a worker that dies mid batch only delays its rows
+    def __init__(self, config):
+        self.config = config
+        self._wake = asyncio.Event()
+        self._task = None
+        self._stopping = False
+        self._draining = False
+
+    async def enqueue(self, recipients, subject, body, subtype='html', using_db=None):
+        now = timezone.now()
+        email = await OutboxEmail.create(recipients=list(recipients), subject=subject, body=body, subtype=subtype,
+                                         next_attempt_at=now, created_at=now, using_db=using_db)
+        self._wake.set()
+        return email
+
+    async def _claim(self):
+        now = timezone.now()
+        due = await OutboxEmail.filter(status=PENDING, next_attempt_at__lte=now).order_by('next_attempt_at', 'id'). \
+            limit(batch_size).values_list('id', flat=True)
+        if not due:
+            return []
+        claim = secrets.token_hex(8)
+        await OutboxEmail.filter(id__in=due, status=PENDING, next_attempt_at__lte=now). \
+            update(claimed_by=claim, next_attempt_at=now + timedelta(seconds=claim_seconds))
+        return await OutboxEmail.filter(claimed_by=claim).order_by('id')
+
+    async def _message(self, email):
+        # Same MIME building FastMail.send_message does, without opening a connection per message
+        schema = MessageSchema(subject=email.subject, recipients=email.recipients, body=email.body,
+                               subtype=MessageType(email.subtype))
+        sender = self.config.MAIL_FROM
+        if self.config.MAIL_FROM_NAME is not None:
+            sender = f'{self.config.MAIL_FROM_NAME} <{self.config.MAIL_FROM}>'
+        return await MailMsg(schema)._message(sender)
+
+    async def _deliver(self, emails):
+        # Returns email id -> None when sent, or the error that stopped it
+        results = {}
+        session_error = None
+        try:
+            async with Connection(self.config) as connection:
+                for email in emails:
+                    while delay := send_limiter.acquire('smtp'):
+                        await asyncio.sleep(delay)
+                    try:
+                        if not self.config.SUPPRESS_SEND:
+                            await connection.session.send_message(await self._message(email))
+                        results[email.id] = None
+                    except Exception as error:
+                        results[email.id] = error
+                        if not self.config.SUPPRESS_SEND and not connection.session.is_connected:
+                            session_error = error
+                            break
+        except Exception as error:
+            session_error = error
+        if session_error is not None:
+            logger.warning('SMTP session failed: %s', session_error)
+        return {email.id: results.get(email.id, session_error) for email in emails}
+
+    async def _record(self, emails, results):
+        now = timezone.now()
+        sent = [email_id for email_id, error in results.items() if error is None]
+        if sent:
+            await OutboxEmail.filter(id__in=sent).update(status=SENT, sent_at=now, claimed_by=None, last_error=None)
+            outbox_emails.inc(len(sent), result=SENT)
+        for email in emails:
+            error = results[email.id]
+            if error is None:
+                continue
+            attempts = email.attempts + 1
+            if attempts >= max_attempts:
+                logger.error('Giving up on email %s after %d attempts: %s', email.id, attempts, error)
+                await OutboxEmail.filter(id=email.id).update(status=FAILED, attempts=attempts, claimed_by=None,
+                                                             last_error=str(error))
+                outbox_emails.inc(result=FAILED)
+                continue
+            delay = min(retry_max_seconds, retry_base_seconds * 2 ** (attempts - 1))
+            await OutboxEmail.filter(id=email.id).update(attempts=attempts, claimed_by=None, last_error=str(error),
+                                                         next_attempt_at=now + timedelta(seconds=delay))
+            outbox_emails.inc(result='retried')
+
+    async def drain(self):
+        while not self._stopping:
+            emails = await self._claim()
+            if not emails:
+                return
+            await self._record(emails, await self._deliver(emails))
+
+    async def compact(self):
+        cutoff = timezone.now() - timedelta(days=retention_days)
+        return await OutboxEmail.filter(status=SENT, sent_at__lt=cutoff).delete()
+
+    async def _run(self):
+        compacted_at = time.monotonic()
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), poll_interval)
+                # Let a burst of registrations land so it goes out over one connection
+                await asyncio.sleep(batch_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                self._draining = True
+                await self.drain()
+                self._draining = False
+                if time.monotonic() - compacted_at >= compaction_interval:
+                    compacted_at = time.monotonic()
+                    await self.compact()
+            except Exception:
+                logger.exception('Draining the outbox failed')
+            finally:
+                self._draining = False
+
+    async def start(self):
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # A batch in flight is left to record its results, cutting it off between the send and _record would
+        # send it again once the claim runs out. An idle worker is cancelled right away
+        if self._task is None:
+            return
+        self._stopping = True
+        if not self._draining:
+            self._task.cancel()
+        try:
+            await asyncio.wait_for(self._task, stop_timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Outbox batch still running after %s seconds, cancelled it', stop_timeout)
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+outbox = Outbox(mail_config)
@@ -0,0 +1,55 @@
+import base64
+import json
+
+from fastapi import HTTPException
+from tortoise.expressions import Q
+
+STREAM_BATCH_SIZE = 200
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':'), default=str).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, types):
+    # types holds one cast per sort key, a None value is kept as is
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError(cursor)
+        return [None if value is None else cast(value) for cast, value in zip(types, values)]
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail='Invalid cursor')
+
+
+def after(fields, values):
+    # Rows strictly after values in ascending order of fields, with NULLs first as SQLite sorts them
+    clauses = []
+    for index, (field, value) in enumerate(zip(fields, values)):
+        clause = Q(**{f'{field}__isnull': False}) if value is None else Q(**{f'{field}__gt': value})
+        for previous_field, previous_value in zip(fields[:index], values[:index]):
+            clause &= Q(**{f'{previous_field}__isnull': True}) if previous_value is None \
+                else Q(**{previous_field: previous_value})
+        clauses.append(clause)
+    return Q(*clauses, join_type='OR')
+
+
+async def keyset_page(queryset, fields, columns, cursor_values, limit):
+    # fields are the sort keys and must be part of columns
+    if cursor_values is not None:
+        queryset = queryset.filter(after(fields, cursor_values))
+    rows = await queryset.order_by(*fields).limit(limit).values(*columns)
+    next_cursor = None
+    if len(rows) == limit:
+        next_cursor = [rows[-1][field] for field in fields]
+    return rows, next_cursor
+
+
+async def keyset_stream(queryset, fields, columns, batch_size=STREAM_BATCH_SIZE):
+    cursor_values = None
+    while True:
+        rows, cursor_values = await keyset_page(queryset, fields, columns, cursor_values, batch_size)
+        for row in rows:
+            yield row
+        if cursor_values is None:
+            return
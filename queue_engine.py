@@ -0,0 +1,381 @@
+import asyncio
+import os
+import uuid
+from collections import OrderedDict
+from contextlib import AsyncExitStack, asynccontextmanager
+from datetime import timedelta
+from math import log
+from random import random
+
+from tortoise import connections, timezone
+from tortoise.exceptions import IntegrityError
+from tortoise.transactions import in_transaction
+
+from models import InfoQueue, QueueEvent
+from bus import bus
+from queue_stats import queue_stats, ENQUEUE, COMPLETE, REMOVE
+from settings import WRITE_CONNECTION
+from versions import versions
+
+# Loaded queues are kept in an LRU, an evicted queue is simply reloaded from the database on next access
+queue_cache_size = int(os.getenv('QUEUE_CACHE_SIZE', 1024))
+# created_at is when the user joined and never changes, sort_at starts equal to it and is what reorder rewrites
+QUEUE_FIELDS = ('id', 'user_id', 'position', 'group_id', 'first_name', 'last_name', 'task_number', 'subject_number',
+                'created_at', 'sort_at', 'modified_at')
+
+
+class _End:
+    # Sorts after every key, terminates each level of the skiplist
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+    def __ge__(self, other):
+        return True
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, next_nodes, widths):
+        self.key = key
+        self.next = next_nodes
+        self.width = widths
+
+
+_NIL = _Node(_End(), [], [])
+
+
+class IndexableSkiplist:
+    # Sorted keys with O(log n) insert, remove and index lookups
+    max_levels = 16
+
+    def __init__(self):
+        self.size = 0
+        self.head = _Node(None, [_NIL] * self.max_levels, [1] * self.max_levels)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        node = self.head.next[0]
+        while node is not _NIL:
+            yield node.key
+            node = node.next[0]
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        node = self.head
+        index += 1
+        for level in reversed(range(self.max_levels)):
+            while node.width[level] <= index:
+                index -= node.width[level]
+                node = node.next[level]
+        return node.key
+
+    def insert(self, key):
+        chain = [None] * self.max_levels
+        steps_at_level = [0] * self.max_levels
+        node = self.head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        depth = min(self.max_levels, 1 - int(log(1.0 - random(), 2.0)))
+        new_node = _Node(key, [None] * depth, [None] * depth)
+        steps = 0
+        for level in range(depth):
+            prev_node = chain[level]
+            new_node.next[level] = prev_node.next[level]
+            prev_node.next[level] = new_node
+            new_node.width[level] = prev_node.width[level] - steps
+            prev_node.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(depth, self.max_levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * self.max_levels
+        node = self.head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target is _NIL or target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev_node = chain[level]
+            prev_node.width[level] += target.width[level] - 1
+            prev_node.next[level] = target.next[level]
+        for level in range(len(target.next), self.max_levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def slice_after(self, key, limit):
+        # Rank of the first key greater than key (None for the start) and up to limit keys from there
+        node = self.head
+        rank = 0
+        if key is not None:
+            for level in reversed(range(self.max_levels)):
+                while node.next[level].key <= key:
+                    rank += node.width[level]
+                    node = node.next[level]
+        keys = []
+        node = node.next[0]
+        while node is not _NIL and len(keys) < limit:
+            keys.append(node.key)
+            node = node.next[0]
+        return rank, keys
+
+
+
+def _timestamp(value):
+    # Naive values are read in tortoise's timezone as DatetimeField.to_python_value does, so rows built in
+    # process and rows loaded from the database always compare
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.get_timezone())
+    return value.timestamp()
+
+
+def _sort_key(row):
+    return _timestamp(row['sort_at']), row['task_number'], row['id']
+
+
+def _normalize(value):
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return str(value)
+
+
+class SubjectQueue:
+    def __init__(self, rows):
+        self._order = IndexableSkiplist()
+        self._by_key = {}
+        self._by_user = {}
+        for row in rows:
+            self.add(row)
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, user_id):
+        return user_id in self._by_user
+
+    def add(self, row):
+        key = _sort_key(row)
+        self._order.insert(key)
+        self._by_key[key] = row
+        self._by_user[row['user_id']] = row
+
+    def remove(self, user_id):
+        row = self._by_user.pop(user_id, None)
+        if row is not None:
+            key = _sort_key(row)
+            self._order.remove(key)
+            del self._by_key[key]
+        return row
+
+    def page(self, after, limit):
+        rank, keys = self._order.slice_after(after, limit)
+        rows = [dict(self._by_key[key], position=rank + offset) for offset, key in enumerate(keys, 1)]
+        return rows, list(keys[-1]) if len(keys) == limit else None
+
+    def snapshot(self):
+        return [dict(self._by_key[key], position=position) for position, key in enumerate(self._order, 1)]
+
+
+class QueueEngine:
+    def __init__(self, max_queues=queue_cache_size):
+        self.max_queues = max_queues
+        self._queues = OrderedDict()
+        # key -> [lock, holders and waiters], dropped once nobody uses it
+        self._locks = {}
+        self._listeners = []
+
+    def key(self, group_id, subject):
+        return _normalize(group_id), _normalize(subject)
+
+    def version(self, key):
+        return versions.current('queue', *key)
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def _changed(self, key):
+        versions.bump('queue', *key)
+        for callback in self._listeners:
+            callback(key)
+
+    def invalidate(self, group_id, subject):
+        # Another worker changed this queue, reload it from the database on next access
+        key = self.key(group_id, subject)
+        self._queues.pop(key, None)
+        self._changed(key)
+
+    @asynccontextmanager
+    async def _lock(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def _store(self, key, queue):
+        self._queues[key] = queue
+        self._queues.move_to_end(key)
+        if len(self._queues) > self.max_queues:
+            for stale in [stale for stale in self._queues if stale not in self._locks]:
+                del self._queues[stale]
+                if len(self._queues) <= self.max_queues:
+                    break
+        return queue
+
+    async def _load(self, key, group_id, subject):
+        queue = self._queues.get(key)
+        if queue is None:
+            rows = await InfoQueue.filter(subject_number=subject, group_id=group_id).values(*QUEUE_FIELDS)
+            return self._store(key, SubjectQueue(rows))
+        self._queues.move_to_end(key)
+        return queue
+
+    async def snapshot(self, group_id, subject):
+        key = self.key(group_id, subject)
+        async with self._lock(key):
+            queue = await self._load(key, group_id, subject)
+            return queue.snapshot()
+
+    async def page(self, group_id, subject, after, limit):
+        key = self.key(group_id, subject)
+        async with self._lock(key):
+            queue = await self._load(key, group_id, subject)
+            return queue.page(None if after is None else tuple(after), limit)
+
+    async def enqueue(self, group_id, subject, user_id, **fields):
+        key = self.key(group_id, subject)
+        async with self._lock(key):
+            queue = await self._load(key, group_id, subject)
+            if user_id in queue:
+                return False
+            now = timezone.now()
+            try:
+                entry = await InfoQueue.create(user_id=user_id, position=len(queue) + 1, group_id=group_id,
+                                               subject_number=subject, created_at=now, sort_at=now, **fields)
+            except IntegrityError:
+                return False
+            queue.add({field: getattr(entry, field) for field in QUEUE_FIELDS})
+            self._changed(key)
+            await bus.publish('queue', *key, local=False)
+            await queue_stats.record([QueueEvent(group_id=group_id, subject_number=subject, user_id=user_id,
+                                                 kind=ENQUEUE, created_at=entry.created_at)])
+            return True
+
+    async def dequeue(self, group_id, subject, user_id):
+        key = self.key(group_id, subject)
+        async with self._lock(key):
+            queue = await self._load(key, group_id, subject)
+            deleted = await InfoQueue.filter(user_id=user_id, subject_number=subject).delete()
+            row = queue.remove(user_id)
+            if deleted:
+                self._changed(key)
+                await bus.publish('queue', *key, local=False)
+                now = timezone.now()
+                wait_seconds = now.timestamp() - _timestamp(row['created_at']) if row else None
+                await queue_stats.record([QueueEvent(group_id=group_id, subject_number=subject, user_id=user_id,
+                                                     kind=COMPLETE, wait_seconds=wait_seconds, created_at=now)])
+            return deleted
+
+    async def apply_batch(self, group_id, operations, members):
+        # Replays the operations on copies of the affected queues, then writes the net
+        # difference in one transaction and reloads those queues with a single query
+        subjects = {}
+        for operation in operations:
+            subjects.setdefault(self.key(group_id, operation.subject_number), operation.subject_number)
+        keys = sorted(subjects)
+        async with AsyncExitStack() as stack:
+            for key in keys:
+                await stack.enter_async_context(self._lock(key))
+            working = {}
+            originals = {}
+            for key in keys:
+                queue = await self._load(key, group_id, subjects[key])
+                rows = queue.snapshot()
+                working[key] = {row['user_id']: dict(row) for row in rows}
+                originals.update((row['id'], (key, row)) for row in rows)
+
+            stamp = timezone.now()
+            for operation in operations:
+                entries = working[self.key(group_id, operation.subject_number)]
+                if operation.op == 'enqueue' and operation.user_id not in entries:
+                    stamp += timedelta(microseconds=1)
+                    member = members[operation.user_id]
+                    entries[operation.user_id] = {'id': None, 'user_id': operation.user_id, 'group_id': group_id,
+                                                  'subject_number': operation.subject_number,
+                                                  'first_name': member['first_name'],
+                                                  'last_name': member['last_name'],
+                                                  'task_number': operation.task_number, 'created_at': stamp,
+                                                  'sort_at': stamp}
+                elif operation.op == 'dequeue':
+                    entries.pop(operation.user_id, None)
+                elif operation.op == 'clear':
+                    entries.clear()
+                elif operation.op == 'reorder':
+                    listed = [entries[user_id] for user_id in operation.order if user_id in entries]
+                    stamps = sorted((row['sort_at'] for row in listed), key=_timestamp)
+                    for row, row_stamp in zip(listed, stamps):
+                        row['sort_at'] = row_stamp
+
+            final_rows = [row for entries in working.values() for row in entries.values()]
+            deleted = originals.keys() - {row['id'] for row in final_rows}
+            created = [InfoQueue(position=0, **{field: value for field, value in row.items()
+                                                if field in QUEUE_FIELDS and field not in ('id', 'position')})
+                       for row in final_rows if row['id'] is None]
+            moved = [InfoQueue(id=row['id'], sort_at=row['sort_at']) for row in final_rows
+                     if row['id'] is not None and row['sort_at'] != originals[row['id']][1]['sort_at']]
+            now = timezone.now()
+            events = [QueueEvent(group_id=group_id, subject_number=row['subject_number'], user_id=row['user_id'],
+                                 kind=ENQUEUE, created_at=row['created_at'])
+                      for row in final_rows if row['id'] is None]
+            events.extend(QueueEvent(group_id=group_id, subject_number=row['subject_number'], user_id=row['user_id'],
+                                     kind=REMOVE, created_at=now)
+                          for _, row in (originals[entry_id] for entry_id in deleted))
+            async with in_transaction(WRITE_CONNECTION) as connection:
+                if deleted:
+                    await InfoQueue.filter(id__in=deleted).using_db(connection).delete()
+                if created:
+                    await InfoQueue.bulk_create(created, using_db=connection)
+                if moved:
+                    await InfoQueue.bulk_update(moved, fields=['sort_at'], using_db=connection)
+                if events:
+                    await queue_stats.record(events, using_db=connection)
+
+            rows_by_key = {key: [] for key in keys}
+            rows = await InfoQueue.filter(group_id=group_id, subject_number__in=list(subjects.values())). \
+                using_db(connections.get(WRITE_CONNECTION)).values(*QUEUE_FIELDS)
+            for row in rows:
+                rows_by_key[self.key(group_id, row['subject_number'])].append(row)
+            states = {}
+            for key in keys:
+                queue = self._store(key, SubjectQueue(rows_by_key[key]))
+                self._changed(key)
+                await bus.publish('queue', *key, local=False)
+                states[key[1]] = queue.snapshot()
+            return states
+
+
+queue_engine = QueueEngine()
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from bisect import bisect_left
+
+from fastapi.encoders import jsonable_encoder
+
+from queue_engine import queue_engine
+
+# Positions are not sent, they follow from the order of the entries
+ENTRY_FIELDS = ('id', 'user_id', 'task_number', 'first_name', 'last_name')
+
+logger = logging.getLogger('queue_events')
+
+
+def _entries(rows):
+    return jsonable_encoder([{field: row[field] for field in ENTRY_FIELDS} for row in rows])
+
+
+def _longest_increasing(values):
+    # Indexes of one longest strictly increasing subsequence of values, O(n log n)
+    tail_values, tails = [], []
+    previous = [None] * len(values)
+    for index, value in enumerate(values):
+        slot = bisect_left(tail_values, value)
+        if slot:
+            previous[index] = tails[slot - 1]
+        if slot == len(tails):
+            tail_values.append(value)
+            tails.append(index)
+        else:
+            tail_values[slot] = value
+            tails[slot] = index
+    kept = set()
+    index = tails[-1] if tails else None
+    while index is not None:
+        kept.add(index)
+        index = previous[index]
+    return kept
+
+
+def _diff(previous, current):
+    # Entries that kept their relative order stay where they are. Every other entry is sent as a removal
+    # plus an insertion at its new index; the client applies the removals, then the insertions in order.
+    # Removing the head of the queue therefore costs one id, not a resend of everyone behind it.
+    before = {entry['id']: (index, entry) for index, entry in enumerate(previous)}
+    common = [index for index, entry in enumerate(current) if before.get(entry['id'], (None, None))[1] == entry]
+    stable = _longest_increasing([before[current[index]['id']][0] for index in common])
+    kept = {current[common[index]]['id'] for index in stable}
+    removed = [entry['id'] for entry in previous if entry['id'] not in kept]
+    inserted = [{'index': index, 'entry': entry} for index, entry in enumerate(current) if entry['id'] not in kept]
+    return removed, inserted
+
+
+class _Channel:
+    def __init__(self):
+        self.subscribers = set()
+        self.dirty = asyncio.Event()
+        self.task = None
+        self.sequence = 0
+        self.entries = None
+        self.snapshot = None
+        self.diff = None
+
+
+class QueueBroadcaster:
+    # One task per watched queue reads the queue once per change and builds the diff once, every subscriber
+    # is handed the same message. A subscriber is a single flag plus the last sequence it sent, so a burst of
+    # changes or a slow consumer collapses into one fresh snapshot instead of a growing backlog of messages
+    coalesce_delay = 0.05
+    retry_delay = 1.0
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._channels = {}
+        engine.add_listener(self.publish)
+
+    def publish(self, key):
+        channel = self._channels.get(key)
+        if channel is not None:
+            channel.dirty.set()
+
+    def subscriber_count(self):
+        return sum(len(channel.subscribers) for channel in self._channels.values())
+
+    async def _follow(self, key, channel):
+        while True:
+            await channel.dirty.wait()
+            if channel.entries is not None:
+                await asyncio.sleep(self.coalesce_delay)
+            channel.dirty.clear()
+            try:
+                entries = _entries(await self._engine.snapshot(*key))
+            except Exception:
+                logger.exception('Reading queue %s for subscribers failed', key)
+                await asyncio.sleep(self.retry_delay)
+                channel.dirty.set()
+                continue
+            version = self._engine.version(key)
+            removed, inserted = _diff(channel.entries, entries) if channel.entries is not None else ([], entries)
+            if channel.entries is not None and not removed and not inserted:
+                continue
+            channel.sequence += 1
+            channel.entries = entries
+            channel.snapshot = {'type': 'snapshot', 'version': version, 'entries': entries}
+            channel.diff = {'type': 'diff', 'version': version, 'removed': removed, 'inserted': inserted}
+            for pending in channel.subscribers:
+                pending.set()
+
+    async def updates(self, group_id, subject):
+        key = self._engine.key(group_id, subject)
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = self._channels[key] = _Channel()
+            channel.dirty.set()
+            channel.task = asyncio.create_task(self._follow(key, channel))
+        pending = asyncio.Event()
+        channel.subscribers.add(pending)
+        if channel.sequence:
+            pending.set()
+        sent = None
+        try:
+            while True:
+                await pending.wait()
+                pending.clear()
+                message = channel.diff if sent == channel.sequence - 1 else channel.snapshot
+                sent = channel.sequence
+                yield message
+        finally:
+            channel.subscribers.discard(pending)
+            if not channel.subscribers and self._channels.get(key) is channel:
+                channel.task.cancel()
+                del self._channels[key]
+
+
+queue_broadcaster = QueueBroadcaster(queue_engine)
@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta
+
+from tortoise import timezone
+
+from models import QueueEvent
+from pagination import STREAM_BATCH_SIZE, keyset_stream
+
+ENQUEUE = 1
+COMPLETE = 2
+REMOVE = 3
+
+logger = logging.getLogger('queue_stats')
+stats_window_hours = int(os.getenv('QUEUE_STATS_WINDOW_HOURS', 168))
+event_retention_days = int(os.getenv('QUEUE_EVENT_RETENTION_DAYS', 30))
+compaction_interval = int(os.getenv('QUEUE_EVENT_COMPACTION_SECONDS', 3600))
+poll_interval = float(os.getenv('QUEUE_STATS_POLL_SECONDS', 1))
+EVENT_FIELDS = ('id', 'group_id', 'subject_number', 'kind', 'wait_seconds', 'created_at')
+
+# Upper bounds in seconds of the wait-time histogram, the last bucket is open ended
+WAIT_BOUNDS = (30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200, 10800, 14400, 21600, 43200, 86400)
+
+
+class HourBucket:
+    __slots__ = ('enqueued', 'completed', 'removed', 'wait_total', 'wait_min', 'wait_max', 'waits')
+
+    def __init__(self):
+        self.enqueued = 0
+        self.completed = 0
+        self.removed = 0
+        self.wait_total = 0.0
+        self.wait_min = None
+        self.wait_max = None
+        self.waits = [0] * (len(WAIT_BOUNDS) + 1)
+
+
+def _wait_bucket(seconds):
+    for index, bound in enumerate(WAIT_BOUNDS):
+        if seconds <= bound:
+            return index
+    return len(WAIT_BOUNDS)
+
+
+def _percentile(waits, count, fraction, lowest, highest):
+    # Interpolates linearly inside the histogram bucket, clamped to the waits actually observed
+    if not count:
+        return None
+    threshold = fraction * count
+    seen = 0
+    for index, bucket_count in enumerate(waits):
+        if bucket_count and seen + bucket_count >= threshold:
+            lower = WAIT_BOUNDS[index - 1] if index else 0.0
+            upper = WAIT_BOUNDS[index] if index < len(WAIT_BOUNDS) else highest
+            value = lower + (upper - lower) * (threshold - seen) / bucket_count
+            return min(max(value, lowest), highest)
+        seen += bucket_count
+    return highest
+
+
+class SubjectStats:
+    # One bucket per hour for the last stats_window_hours, so a summary never depends on history size
+    def __init__(self):
+        self.hours = {}
+
+    def _expire(self, hour):
+        oldest = hour - stats_window_hours
+        for stale in [stale for stale in self.hours if stale <= oldest]:
+            del self.hours[stale]
+
+    def observe(self, kind, hour, wait_seconds):
+        if hour <= current_hour() - stats_window_hours:
+            return
+        bucket = self.hours.get(hour)
+        if bucket is None:
+            bucket = self.hours[hour] = HourBucket()
+            self._expire(hour)
+        if kind == ENQUEUE:
+            bucket.enqueued += 1
+        elif kind == REMOVE:
+            bucket.removed += 1
+        elif kind == COMPLETE:
+            bucket.completed += 1
+            if wait_seconds is not None:
+                bucket.wait_total += wait_seconds
+                bucket.wait_min = wait_seconds if bucket.wait_min is None else min(bucket.wait_min, wait_seconds)
+                bucket.wait_max = wait_seconds if bucket.wait_max is None else max(bucket.wait_max, wait_seconds)
+                bucket.waits[_wait_bucket(wait_seconds)] += 1
+
+    def summary(self):
+        hour = current_hour()
+        self._expire(hour)
+        enqueued = completed = removed = 0
+        wait_total = 0.0
+        waits = [0] * (len(WAIT_BOUNDS) + 1)
+        extremes = []
+        for bucket in self.hours.values():
+            enqueued += bucket.enqueued
+            completed += bucket.completed
+            removed += bucket.removed
+            wait_total += bucket.wait_total
+            waits = [total + count for total, count in zip(waits, bucket.waits)]
+            if bucket.wait_min is not None:
+                extremes.extend((bucket.wait_min, bucket.wait_max))
+        timed = sum(waits)
+        last_hour = self.hours.get(hour)
+        hours_covered = hour - min(self.hours) + 1 if self.hours else 1
+        lowest, highest = (min(extremes), max(extremes)) if extremes else (None, None)
+        return {
+            'window_hours': stats_window_hours,
+            'enqueued': enqueued,
+            'completed': completed,
+            'removed': removed,
+            'average_wait_seconds': wait_total / timed if timed else None,
+            'p50_wait_seconds': _percentile(waits, timed, 0.50, lowest, highest),
+            'p90_wait_seconds': _percentile(waits, timed, 0.90, lowest, highest),
+            'p99_wait_seconds': _percentile(waits, timed, 0.99, lowest, highest),
+            'completed_last_hour': last_hour.completed if last_hour else 0,
+            'throughput_per_hour': completed / hours_covered,
+        }
+
+
+def current_hour():
+    return int(timezone.now().timestamp() // 3600)
+
+
+class QueueStats:
+    # Every worker, the writer included, aggregates events by tailing the QueueEvent table by id,
+    # so all workers converge on the same numbers whichever of them handled the write
+    def __init__(self):
+        self._subjects = {}
+        self._last_id = 0
+        self._task = None
+
+    def observe(self, key, kind, at, wait_seconds=None):
+        stats = self._subjects.get(key)
+        if stats is None:
+            stats = self._subjects[key] = SubjectStats()
+        stats.observe(kind, int(at.timestamp() // 3600), wait_seconds)
+
+    def _observe_row(self, row):
+        self.observe((str(row['group_id']), str(row['subject_number'])), row['kind'], row['created_at'],
+                     row['wait_seconds'])
+
+    def summary(self, key):
+        stats = self._subjects.get(key)
+        return (stats or SubjectStats()).summary()
+
+    async def record(self, events, using_db=None):
+        # events is a list of unsaved QueueEvent, written in one insert and picked up by catch_up
+        await QueueEvent.bulk_create(events, using_db=using_db)
+
+    async def warm(self):
+        latest = await QueueEvent.all().order_by('-id').first().values('id')
+        self._last_id = latest['id'] if latest else 0
+        since = timezone.now() - timedelta(hours=stats_window_hours)
+        events = QueueEvent.filter(created_at__gte=since, id__lte=self._last_id)
+        async for row in keyset_stream(events, ('id',), EVENT_FIELDS):
+            self._observe_row(row)
+
+    async def catch_up(self):
+        while True:
+            rows = await QueueEvent.filter(id__gt=self._last_id).order_by('id').limit(STREAM_BATCH_SIZE). \
+                values(*EVENT_FIELDS)
+            for row in rows:
+                self._last_id = row['id']
+                self._observe_row(row)
+            if len(rows) < STREAM_BATCH_SIZE:
+                return
+
+    async def compact(self):
+        cutoff = timezone.now() - timedelta(days=event_retention_days)
+        return await QueueEvent.filter(created_at__lt=cutoff).delete()
+
+    async def _run(self):
+        compacted_at = time.monotonic()
+        while True:
+            await asyncio.sleep(poll_interval)
+            try:
+                await self.catch_up()
+                if time.monotonic() - compacted_at >= compaction_interval:
+                    compacted_at = time.monotonic()
+                    deleted = await self.compact()
+                    if deleted:
+                        logger.info('Compacted %d queue events', deleted)
+            except Exception:
+                logger.exception('Aggregating queue events failed')
+
+    async def start(self):
+        await self.warm()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+queue_stats = QueueStats()
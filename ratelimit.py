@@ -0,0 +1,68 @@
+import math
+import os
+import time
+from collections import OrderedDict
+
+from fastapi import Depends, HTTPException, status
+
+from authentication import get_current_user
+from metrics import Counter, Gauge, registry
+
+rate_limit_rejections = registry.register(Counter('rate_limit_rejections_total', 'Requests rejected by route class'))
+
+
+class TokenBucketLimiter:
+    # Buckets live in an LRU bounded by max_keys, an evicted user simply starts again with a full bucket
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def acquire(self, key):
+        now = time.monotonic()
+        state = self._buckets.pop(key, None)
+        tokens = self.burst if state is None else min(self.burst, state[0] + (now - state[1]) * self.rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return retry_after
+
+
+rate_limit_max_users = int(os.getenv('RATE_LIMIT_MAX_USERS', 10000))
+limiters = {
+    'read': TokenBucketLimiter(rate=float(os.getenv('RATE_LIMIT_READS_PER_SECOND', 5)),
+                               burst=int(os.getenv('RATE_LIMIT_READ_BURST', 20)), max_keys=rate_limit_max_users),
+    'write': TokenBucketLimiter(rate=float(os.getenv('RATE_LIMIT_WRITES_PER_SECOND', 1)),
+                                burst=int(os.getenv('RATE_LIMIT_WRITE_BURST', 5)), max_keys=rate_limit_max_users),
+}
+registry.register(Gauge('rate_limit_tracked_users', 'Users with a live token bucket by route class',
+                        lambda: {(('route_class', name),): len(limiter) for name, limiter in limiters.items()}))
+
+
+def rate_limit(route_class):
+    limiter = limiters[route_class]
+
+    async def check_rate_limit(current_user=Depends(get_current_user)):
+        retry_after = limiter.acquire(current_user.id)
+        if retry_after:
+            rate_limit_rejections.inc(route_class=route_class)
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+
+    return check_rate_limit
+
+
+limit_reads = rate_limit('read')
+limit_writes = rate_limit('write')
@@ -0,0 +1,66 @@
+import os
+from itertools import cycle
+
+from dotenv import load_dotenv
+from tortoise.backends.base.config_generator import expand_db_url
+
+load_dotenv()
+database_url = os.getenv('DATABASE_URL', 'sqlite://db.sqlite3')
+database_read_url = os.getenv('DATABASE_READ_URL', database_url)
+database_read_connections = int(os.getenv('DATABASE_READ_CONNECTIONS', 0))
+database_pool_min = int(os.getenv('DATABASE_POOL_MIN', 1))
+database_pool_max = int(os.getenv('DATABASE_POOL_MAX', 10))
+sqlite_profile = os.getenv('SQLITE_PROFILE', 'production')
+
+# Applied by tortoise as PRAGMA statements every time a connection is opened
+SQLITE_PROFILES = {
+    'default': {},
+    'production': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+    },
+}
+
+WRITE_CONNECTION = 'default'
+READ_CONNECTIONS = [f'read_{number}' for number in range(database_read_connections)]
+
+
+def connection_config(url):
+    config = expand_db_url(url)
+    if config['engine'] == 'tortoise.backends.sqlite':
+        config['credentials'].update(SQLITE_PROFILES[sqlite_profile])
+    else:
+        config['credentials'].setdefault('minsize', database_pool_min)
+        config['credentials'].setdefault('maxsize', database_pool_max)
+    return config
+
+
+class ReadWriteRouter:
+    # Spreads reads over the read connections, every write goes to the single writer
+    def __init__(self):
+        self._reads = cycle(READ_CONNECTIONS) if READ_CONNECTIONS else None
+
+    def db_for_read(self, model):
+        return next(self._reads) if self._reads else None
+
+    def db_for_write(self, model):
+        return WRITE_CONNECTION
+
+
+TORTOISE_ORM = {
+    'connections': {
+        WRITE_CONNECTION: connection_config(database_url),
+        **{name: connection_config(database_read_url) for name in READ_CONNECTIONS},
+    },
+    'apps': {
+        'models': {
+            'models': ['models'],
+            'default_connection': WRITE_CONNECTION,
+        },
+    },
+    'routers': ['settings.ReadWriteRouter'],
+}
@@ -0,0 +1,70 @@
+import asyncio
+import os
+import types
+
+import pytest
+from tortoise import timezone
+
+from benchmark import seed
+
+REDEEMERS = 300
+ACTIVATIONS = 250
+MEMBER_TOKEN_ACTIVATIONS = 5
+
+
+async def redeem_all(client, token, headers):
+    responses = await asyncio.gather(*(client.post(f'/user/enter_invitation_token/{token}', headers=header)
+                                       for header in headers))
+    return [response.status_code for response in responses]
+
+
+async def collect_redemptions(path):
+    # Every redemption is sent at once through one app instance against a seeded WAL database
+    os.environ['DATABASE_URL'] = f'sqlite://{path}'
+    import httpx
+    from main import app
+    from models import Tokens, User
+
+    await app.router.startup()
+    try:
+        data = await seed(types.SimpleNamespace(users=20, subjects=1, redeemers=REDEEMERS, activations=ACTIVATIONS))
+        moderator = await User.get(email='moderator@bench.local')
+        await Tokens.create(token='membertoken', remaining_activations=MEMBER_TOKEN_ACTIVATIONS,
+                            group_id=moderator.group_id, owner_id=moderator.id,
+                            expires=moderator.subscription_expires)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+            guests = await redeem_all(client, 'benchmarktoken', [data['bearer'](email) for email in data['guests']])
+            members = await redeem_all(client, 'membertoken', [data['bearer'](email) for email in data['students']])
+        return {
+            'guests': guests,
+            'members': members,
+            'remaining': {row['token']: row['remaining_activations']
+                          for row in await Tokens.all().values('token', 'remaining_activations')},
+            'joined': await User.filter(email__in=data['guests'], group_id=moderator.group_id).count(),
+            'expired_early': await User.filter(email__in=data['guests'], group_id__isnull=False,
+                                               subscription_expires__lte=timezone.now()).count(),
+        }
+    finally:
+        await app.router.shutdown()
+
+
+@pytest.fixture(scope='module')
+def redemptions(tmp_path_factory):
+    os.environ.setdefault('BCRYPT_ROUNDS', '4')
+    os.environ.setdefault('SECRET', 'test-secret')
+    os.environ.setdefault('SECRET_EMAIL', 'test@example.com')
+    os.environ.setdefault('MAIL_SUPPRESS_SEND', '1')
+    return asyncio.run(collect_redemptions(tmp_path_factory.mktemp('tokens') / 'tokens.sqlite3'))
+
+
+def test_concurrent_redemptions_accept_exactly_the_activations(redemptions):
+    assert redemptions['guests'].count(200) == ACTIVATIONS
+    assert redemptions['guests'].count(400) == REDEEMERS - ACTIVATIONS
+    assert redemptions['remaining']['benchmarktoken'] == 0
+    assert redemptions['joined'] == ACTIVATIONS
+    assert redemptions['expired_early'] == 0
+
+
+def test_members_of_a_group_do_not_use_up_activations(redemptions):
+    assert set(redemptions['members']) == {400}
+    assert redemptions['remaining']['membertoken'] == MEMBER_TOKEN_ACTIVATIONS
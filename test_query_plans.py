@@ -0,0 +1,86 @@
+import asyncio
+import os
+import types
+
+import pytest
+from tortoise import Tortoise, connections, timezone
+from tortoise.expressions import F
+
+from benchmark import seed
+from migrations import run_migrations
+from pagination import after
+
+# Hot query shapes of the endpoints, each must be answered through an index rather than a full table scan
+QUERY_SHAPES = [
+    'infoqueue_load',
+    'infoqueue_dequeue',
+    'infoqueue_batch_reload',
+    'subjects_by_group',
+    'subject_by_id',
+    'user_by_email',
+    'user_by_id',
+    'users_by_group',
+    'users_by_group_after_cursor',
+    'tokens_by_token',
+    'tokens_by_group',
+    'tokens_redeem',
+    'subscription_by_owner',
+]
+
+
+def shapes(ids):
+    from models import InfoQueue, Subjects, Subscription, Tokens, User
+
+    return {
+        'infoqueue_load': InfoQueue.filter(subject_number=ids.subject, group_id=ids.group).values('id', 'user_id'),
+        'infoqueue_dequeue': InfoQueue.filter(user_id=ids.user, subject_number=ids.subject).delete(),
+        'infoqueue_batch_reload': InfoQueue.filter(group_id=ids.group, subject_number__in=[ids.subject]).values('id'),
+        'subjects_by_group': Subjects.filter(group_id=ids.group).order_by('subject_full_name').
+        values('id', 'subject_full_name', 'subject_short_name'),
+        'subject_by_id': Subjects.filter(id=ids.subject),
+        'user_by_email': User.filter(email=ids.email),
+        'user_by_id': User.filter(id=ids.user),
+        'users_by_group': User.filter(group_id=ids.group).order_by('last_name', 'first_name', 'id').
+        limit(50).values('first_name', 'last_name'),
+        'users_by_group_after_cursor': User.filter(group_id=ids.group).
+        filter(after(('last_name', 'first_name', 'id'), ('Bench00010', 'Student10', str(ids.user)))).
+        order_by('last_name', 'first_name', 'id').limit(50).values('first_name', 'last_name'),
+        'tokens_by_token': Tokens.filter(token='benchmarktoken'),
+        'tokens_by_group': Tokens.filter(group_id=ids.group),
+        'tokens_redeem': Tokens.filter(id=ids.token, remaining_activations__gt=0, expires__gt=timezone.now()).
+        update(remaining_activations=F('remaining_activations') - 1),
+        'subscription_by_owner': Subscription.filter(owner_id=ids.user),
+    }
+
+
+async def collect_plans(path):
+    await Tortoise.init(db_url=f'sqlite://{path}', modules={'models': ['models']})
+    try:
+        await run_migrations('default')
+        data = await seed(types.SimpleNamespace(users=50, subjects=3, redeemers=5, activations=5))
+        from models import Tokens, User
+
+        moderator = await User.get(email='moderator@bench.local')
+        token = await Tokens.get(token='benchmarktoken')
+        ids = types.SimpleNamespace(group=moderator.group_id, user=moderator.id, email=moderator.email,
+                                    subject=data['subjects'][0], token=token.id)
+        connection = connections.get('default')
+        plans = {}
+        for name, queryset in shapes(ids).items():
+            rows = await connection.execute_query_dict(f'EXPLAIN QUERY PLAN {queryset.sql()}')
+            plans[name] = [row['detail'] for row in rows]
+        return plans
+    finally:
+        await Tortoise.close_connections()
+
+
+@pytest.fixture(scope='module')
+def plans(tmp_path_factory):
+    os.environ.setdefault('BCRYPT_ROUNDS', '4')
+    return asyncio.run(collect_plans(tmp_path_factory.mktemp('plans') / 'plans.sqlite3'))
+
+
+@pytest.mark.parametrize('shape', QUERY_SHAPES)
+def test_query_uses_index(plans, shape):
+    scans = [detail for detail in plans[shape] if detail.startswith('SCAN')]
+    assert not scans, f'{shape} scans instead of using an index: {plans[shape]}'
@@ -0,0 +1,27 @@
+import hashlib
+import secrets
+
+# Versions restart with the process, so tags carry a boot id to stay strong across restarts
+boot_id = secrets.token_hex(4)
+
+
+class VersionRegistry:
+    def __init__(self):
+        self._versions = {}
+
+    def current(self, kind, *parts):
+        return self._versions.get((kind, *map(str, parts)), 0)
+
+    def bump(self, kind, *parts):
+        key = (kind, *map(str, parts))
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    def etag(self, kind, *parts, variant=''):
+        # Versions are small per-resource counters, so the resource itself is hashed into the tag
+        # to keep equal versions of different groups or subjects from matching each other
+        resource = '\0'.join((kind, *map(str, parts), variant))
+        digest = hashlib.blake2s(resource.encode(), digest_size=8).hexdigest()
+        return f'"{boot_id}-{self.current(kind, *parts)}-{digest}"'
+
+
+versions = VersionRegistry()